@@ -0,0 +1,55 @@
+"""Пропускная способность записи пациентов из множества корутин.
+
+Сравнивает await patient.asave() в каждой корутине и общий AsyncPatientWriter.
+Запуск из корня репозитория: python -m benchmarks.async_ingest [корутин] [fsync 0/1]
+Файлы пишутся во временный каталог.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import homework.log
+from homework.patient import Patient, AsyncPatientWriter
+
+
+def patients(n):
+    return [Patient.from_trusted_row(['Ада', 'Лавлейс', '1978-01-21', f'79{i:09}', 'паспорт', f'{i:010}'])
+            for i in range(n)]
+
+
+async def with_asave(items):
+    await asyncio.gather(*(patient.asave() for patient in items))
+
+
+async def with_writer(items, fsync):
+    async with AsyncPatientWriter('patients.csv', max_pending=1000, fsync=fsync) as writer:
+        await asyncio.gather(*map(writer.write, items))
+
+
+def measure(coroutine):
+    if os.path.exists('patients.csv'):
+        os.remove('patients.csv')
+    started = time.perf_counter()
+    asyncio.run(coroutine)
+    return time.perf_counter() - started
+
+
+def main(n=5000, fsync=0):
+    homework.log.start_queue_logging()
+    items = patients(n)
+    results = {
+        'asave': measure(with_asave(items)),
+        f'AsyncPatientWriter(fsync={bool(fsync)})': measure(with_writer(items, bool(fsync))),
+    }
+    for name, seconds in results.items():
+        print(f'{name:>32}: {n / seconds:9.0f} patients/s ({seconds:.2f}s for {n} coroutines)')
+    homework.log.stop_queue_logging()
+    return results
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        main(*map(int, sys.argv[1:]))
@@ -0,0 +1,49 @@
+"""Память на одного пациента для Patient, CompactPatient и MemoryPatientCollection.
+
+Запуск из корня репозитория: python -m benchmarks.memory_per_record [число записей]
+"""
+import sys
+import tracemalloc
+
+from homework.patient import Patient, CompactPatient, MemoryPatientCollection
+
+FIRST_NAMES = ('Кондрат', 'Евпатий', 'Ада', 'Миртл', 'Евлампия', 'Кузя', 'Гарри', 'Рон')
+LAST_NAMES = ('Рюрик', 'Коловрат', 'Лавлейс', 'Плакса', 'Фамилия', 'Кузьмин', 'Поттер', 'Уизли')
+
+
+def rows(n):
+    # строки в том виде, в каком их отдаёт разбор csv: новые объекты str на каждую строку
+    for i in range(n):
+        yield [''.join(FIRST_NAMES[i % 8]), ''.join(LAST_NAMES[i // 8 % 8]), f'{1900 + i % 120}-01-{1 + i % 28:02}',
+               f'79{i:09}', 'паспорт', f'{i:010}']
+
+
+def fill(data):
+    collection = MemoryPatientCollection()
+    collection.extend_rows(data)
+    return collection
+
+
+def measure(build, n):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    records = build(rows(n))
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+    return (after - before) / n
+
+
+def main(n=100000):
+    results = {
+        'Patient': measure(lambda data: [Patient.from_trusted_row(row) for row in data], n),
+        'CompactPatient': measure(lambda data: [CompactPatient.from_trusted_row(row) for row in data], n),
+        'MemoryPatientCollection': measure(fill, n),
+    }
+    for name, size in results.items():
+        print(f'{name:>24}: {size:7.1f} bytes per record')
+    return results
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
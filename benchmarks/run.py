@@ -0,0 +1,160 @@
+"""Набор замеров производительности: создание Patient, check_*, save(), обход коллекции, память.
+
+Запуск из корня репозитория:
+    python -m benchmarks.run --rows 10000 100000 --output results.json --baseline benchmarks/baseline.json
+
+Реестры генерируются во временном каталоге, там же пишутся save() и логи. Результат - json
+с секундами и операциями в секунду на каждый замер; с --baseline печатается сравнение и
+отмечаются замеры, ставшие медленнее больше чем на --threshold.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+FIRST_NAMES = ('Кондрат', 'Евпатий', 'Ада', 'Миртл', 'Евлампия', 'Кузя', 'Гарри', 'Рон')
+LAST_NAMES = ('Рюрик', 'Коловрат', 'Лавлейс', 'Плакса', 'Фамилия', 'Кузьмин', 'Поттер', 'Уизли')
+DOCUMENTS = (('паспорт', 10), ('заграничный паспорт', 9), ('водительское удостоверение', 10))
+# позиция поля в строке -> значение, на которое check_* отвечает False
+INVALID = {2: '1978-02-30', 3: '+7-916-ABC', 5: '12'}
+SAMPLE_SIZE = 20000
+
+
+def synthetic_rows(count, invalid_share=0.0, seed=0):
+    # строки в том виде, в каком их присылают: телефон и номер документа с разделителями
+    generator = random.Random(seed)
+    for i in range(count):
+        document_type, length = DOCUMENTS[i % 3]
+        document_id = f'{i:0{length}}'
+        row = [generator.choice(FIRST_NAMES), generator.choice(LAST_NAMES),
+               f'{generator.randint(1900, 2020)}-{generator.randint(1, 12):02}-{generator.randint(1, 28):02}',
+               f'+7 ({916 + i % 3}) {i % 10 ** 7:07}', document_type, f'{document_id[:4]} {document_id[4:]}']
+        if generator.random() < invalid_share:
+            position = generator.choice(tuple(INVALID))
+            row[position] = INVALID[position]
+        yield row
+
+
+def generate_registry(path, count, invalid_share=0.0, seed=0, batch_size=100000):
+    from homework.files import encode_rows
+    from homework.patient import validate_rows
+
+    rows = synthetic_rows(count, invalid_share, seed)
+    with open(path, 'wb') as file:
+        while True:
+            batch = [row for _, row in zip(range(batch_size), rows)]
+            if not batch:
+                return
+            # хорошие строки пишутся нормализованными, как их пишет save(), плохие - как есть
+            normalized, _ = validate_rows(batch)
+            file.write(encode_rows(good or raw for good, raw in zip(normalized, batch)))
+
+
+def timed(fn, operations):
+    started = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - started
+    return {'seconds': seconds, 'operations': operations, 'ops_per_sec': operations / seconds if seconds else 0.0}
+
+
+def run(rows):
+    from homework.patient import Patient, PatientCollection, DocumentType, check_name_value, check_date_value, \
+        check_phone_value, check_document_type_value, check_document_id_value
+    from benchmarks.memory_per_record import main as memory_per_record
+
+    results = {}
+    sample = list(synthetic_rows(min(rows, SAMPLE_SIZE), seed=1))
+    columns = list(zip(*sample))
+    results['Patient()'] = timed(lambda: [Patient(*row) for row in sample], len(sample))
+    checks = {
+        'check_name_value': lambda: list(map(check_name_value, columns[0])),
+        'check_date_value': lambda: list(map(check_date_value, columns[2])),
+        'check_phone_value': lambda: list(map(check_phone_value, columns[3])),
+        'check_document_type_value': lambda: [check_document_type_value(value, DocumentType.possible_types)
+                                              for value in columns[4]],
+        'check_document_id_value': lambda: list(map(check_document_id_value, columns[5], columns[4])),
+    }
+    for name, check in checks.items():
+        results[name] = timed(check, len(sample))
+    patients = list(PatientCollection('valid.csv', validate=False).limit(len(sample)))
+    results['save()'] = timed(lambda: [patient.save() for patient in patients], len(patients))
+
+    collection = PatientCollection('valid.csv')
+    results['iteration'] = timed(lambda: sum(1 for _ in collection), rows)
+    results['iteration(validate=False)'] = timed(
+        lambda: sum(1 for _ in PatientCollection('valid.csv', validate=False)), rows)
+    results['limit(1000)'] = timed(lambda: sum(1 for _ in collection.limit(1000)), min(rows, 1000))
+    results['find_errors(mixed)'] = timed(lambda: PatientCollection('mixed.csv').find_errors(), rows)
+    results['memory_per_record'] = {
+        name: {'bytes': size} for name, size in memory_per_record(min(rows, SAMPLE_SIZE)).items()}
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for size, size_results in results['results'].items():
+        for name, result in size_results.items():
+            old = baseline.get('results', {}).get(size, {}).get(name, {})
+            if 'ops_per_sec' not in result or not old.get('ops_per_sec'):
+                continue
+            ratio = result['ops_per_sec'] / old['ops_per_sec']
+            mark = ''
+            if ratio < 1 - threshold:
+                mark = '  <- regression'
+                regressions.append((size, name, ratio))
+            print(f'{size:>10} {name:>28}: {ratio:6.2f}x baseline{mark}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000], help='размеры реестров, 10000 .. 10000000')
+    parser.add_argument('--invalid-share', type=float, default=0.1, help='доля плохих строк в mixed-реестре')
+    parser.add_argument('--output', help='куда записать json с результатами')
+    parser.add_argument('--baseline', help='json с прошлыми результатами для сравнения')
+    parser.add_argument('--threshold', type=float, default=0.1, help='допустимое замедление, доля')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args(argv)
+    output = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, project_root)
+
+    results = {'meta': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'rows': args.rows},
+               'results': {}}
+    with tempfile.TemporaryDirectory() as directory:
+        # homework пишет логи и patients.csv в текущий каталог, поэтому импортируем его уже внутри временного
+        os.chdir(directory)
+        for rows in args.rows:
+            generate_registry('valid.csv', rows)
+            generate_registry('mixed.csv', rows, args.invalid_share)
+            results['results'][str(rows)] = run(rows)
+            for name in ('valid.csv', 'mixed.csv', 'patients.csv'):
+                if os.path.exists(name):
+                    os.remove(name)
+            for name, result in results['results'][str(rows)].items():
+                if 'ops_per_sec' in result:
+                    print(f'{rows:>10} {name:>28}: {result["ops_per_sec"]:12.0f} ops/s')
+        import homework.log
+        homework.log.fh_info.close()
+        homework.log.fh_error.close()
+        os.chdir(project_root)
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+    if baseline_path:
+        with open(baseline_path, encoding='utf-8') as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        if regressions and args.fail_on_regression:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
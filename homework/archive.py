@@ -0,0 +1,152 @@
+import lzma
+import os
+import struct
+import zlib
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from homework.files import encode_rows, split_row
+from homework.patient import Patient, PatientCollection, row_checks
+
+MAGIC = b'PTNZ'
+VERSION = 1
+ARCHIVE_SUFFIX = '.csvz'
+HEADER = struct.Struct('<4sHB')
+# блок: смещение, сжатый размер, номер первой строки, число строк, минимальная и максимальная дата рождения
+BLOCK = struct.Struct('<QIQI10s10s')
+# в самом конце файла: смещение оглавления, число блоков, MAGIC
+TRAILER = struct.Struct('<QI4s')
+ROWS_PER_BLOCK = 10000
+CODECS = {
+    'zlib': (0, zlib.compress, zlib.decompress),
+    'lzma': (1, lzma.compress, lzma.decompress),
+}
+DECOMPRESS = {code: decompress for code, _, decompress in CODECS.values()}
+
+
+class ArchiveStorage:
+    """Пациенты в сжатом архиве .csvz: строки csv блоками, каждый блок сжат отдельно (zlib или lzma).
+
+    В конце файла оглавление блоков с номером первой строки и минимальной и максимальной датой рождения,
+    поэтому строка по номеру и диапазон дат читаются с нужного блока, не распаковывая предыдущие.
+    Блоки распаковываются в пуле потоков на workers блоков вперёд (zlib и lzma отпускают GIL).
+    Архив только для чтения, собирается из csv через csv_to_archive().
+    """
+
+    def __init__(self, path, workers=4):
+        self.path = path
+        self.workers = workers
+        with open(path, 'rb') as file:
+            magic, version, self.codec = HEADER.unpack(file.read(HEADER.size))
+            file.seek(-TRAILER.size, os.SEEK_END)
+            footer_offset, count, trailer_magic = TRAILER.unpack(file.read(TRAILER.size))
+            if magic != MAGIC or trailer_magic != MAGIC or version != VERSION or self.codec not in DECOMPRESS:
+                raise ValueError(f'{path} is not a patients archive')
+            file.seek(footer_offset)
+            self.blocks = [BLOCK.unpack(file.read(BLOCK.size)) for _ in range(count)]
+        self.first_rows = [block[2] for block in self.blocks]
+
+    def __len__(self):
+        return sum(block[3] for block in self.blocks)
+
+    def _read_ahead(self, blocks):
+        # pread не двигает общую позицию файла, поэтому потокам хватает одного дескриптора
+        fd = os.open(self.path, os.O_RDONLY)
+        decompress = DECOMPRESS[self.codec]
+
+        def read(block):
+            offset, size = block[:2]
+            data = decompress(os.pread(fd, size, offset))
+            return [split_row(line) for line in data.split(b'\n')[:-1]]
+
+        try:
+            with ThreadPoolExecutor(self.workers) as executor:
+                blocks = iter(blocks)
+                pending = [executor.submit(read, block) for block in islice(blocks, self.workers)]
+                while pending:
+                    rows = pending.pop(0).result()
+                    pending.extend(executor.submit(read, block) for block in islice(blocks, 1))
+                    yield from rows
+        finally:
+            os.close(fd)
+
+    def rows(self, start=0, stop=None):
+        # строки [start, stop): распаковываются только блоки, в которые они попадают
+        if not self.blocks or stop is not None and stop <= start:
+            return iter(())
+        first = max(bisect_right(self.first_rows, start) - 1, 0)
+        last = len(self.blocks) if stop is None else bisect_right(self.first_rows, stop - 1)
+        skip = start - self.first_rows[first]
+        return islice(self._read_ahead(self.blocks[first:last]), skip, None if stop is None else skip + stop - start)
+
+    def row_slice(self, start, stop):
+        return list(self.rows(start, stop))
+
+    def blocks_between(self, since=None, until=None):
+        # блоки, в которых могут быть даты рождения из [since, until]
+        return [block for block in self.blocks
+                if not (since and _date(block[5]) < since or until and _date(block[4]) > until)]
+
+    def find(self, document_type=None, birth_date_between=None, phone_prefix=None, phone=None, document=None):
+        # по датам блоки отбираются по оглавлению
+        checks = row_checks(document_type, birth_date_between, phone_prefix, phone, document)
+        blocks = self.blocks_between(*birth_date_between) if birth_date_between else self.blocks
+        for row in self._read_ahead(blocks):
+            if all(check(row[position]) for position, check in checks):
+                yield row
+
+    def append_rows(self, rows, batch_size=None):
+        raise TypeError('Archive is read-only, rebuild it with csv_to_archive()')
+
+    def save_many(self, patients, batch_size=None):
+        raise TypeError('Archive is read-only, rebuild it with csv_to_archive()')
+
+
+def _date_bytes(date):
+    return date.encode('utf-8')[:10]
+
+
+def _date(value):
+    return value.rstrip(b'\0').decode('utf-8')
+
+
+def write_archive(rows, path_to_archive, codec='zlib', rows_per_block=ROWS_PER_BLOCK):
+    # rows - уже нормализованные строки; блоки пишутся по мере поступления строк
+    code, compress, _ = CODECS[codec]
+    rows = iter(rows)
+    blocks = []
+    first_row = 0
+    with open(path_to_archive, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION, code))
+        while True:
+            batch = list(islice(rows, rows_per_block))
+            if not batch:
+                break
+            data = compress(encode_rows(batch))
+            dates = [row[2] for row in batch]
+            blocks.append(BLOCK.pack(file.tell(), len(data), first_row, len(batch),
+                                     _date_bytes(min(dates)), _date_bytes(max(dates))))
+            file.write(data)
+            first_row += len(batch)
+        footer_offset = file.tell()
+        file.write(b''.join(blocks))
+        file.write(TRAILER.pack(footer_offset, len(blocks), MAGIC))
+    return first_row
+
+
+def csv_to_archive(path_to_csv_file, path_to_archive, codec='zlib', rows_per_block=ROWS_PER_BLOCK, validate=True):
+    rows = PatientCollection(path_to_csv_file, validate=validate).select(*Patient.fields, named=False)
+    return write_archive(rows, path_to_archive, codec, rows_per_block)
+
+
+def archive_to_csv(path_to_archive, path_to_csv_file, batch_size=10000):
+    written = 0
+    rows = ArchiveStorage(path_to_archive).rows()
+    with open(path_to_csv_file, 'ab') as file:
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                return written
+            file.write(encode_rows(batch))
+            written += len(batch)
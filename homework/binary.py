@@ -0,0 +1,219 @@
+import datetime
+import mmap
+import os
+import struct
+
+from homework.files import encode_rows
+from homework.patient import Patient, PatientCollection, MemoryPatientCollection, row_checks
+
+MAGIC = b'PTNB'
+VERSION = 1
+HEADER = struct.Struct('<4sHH')
+# имя и фамилия - номера в словаре имён, дата - номер дня, телефон и номер документа - числа,
+# тип документа - номер в DOCUMENT_TYPES
+RECORD = struct.Struct('<IIIQBQ')
+NAMES_SUFFIX = '.names'
+NAME_LENGTH = struct.Struct('<B')
+DOCUMENT_TYPES = MemoryPatientCollection.DOCUMENT_TYPES
+DOCUMENT_ID_LENGTHS = MemoryPatientCollection.DOCUMENT_ID_LENGTHS
+
+# поле -> (struct одного поля, смещение в записи), чтобы разбирать только нужные поля
+FIELD_STRUCTS = {}
+_offset = 0
+for _field, _code in zip(Patient.fields, RECORD.format[1:]):
+    FIELD_STRUCTS[_field] = (struct.Struct('<' + _code), _offset)
+    _offset += FIELD_STRUCTS[_field][0].size
+
+
+class BinaryStorage:
+    """Пациенты в файле из записей фиксированной длины, читается через mmap.
+
+    Запись i начинается с HEADER.size + i * RECORD.size, поэтому доступ по номеру - O(1),
+    а поля разбираются прямо из отображённой памяти, без чтения файла в буфер. Имена лежат
+    один раз в словаре <path>.names (длина в байте перед строкой), в записи - их номера.
+    Дописывать файл должен один писатель: номера новых имён раздаёт он.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.path_to_names = path + NAMES_SUFFIX
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, 'wb') as file:
+                file.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+            open(self.path_to_names, 'wb').close()
+        with open(path, 'rb') as file:
+            magic, version, record_size = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            raise ValueError(f'{path} is not a binary patients file')
+        self.names = []
+        self.name_ids = {}
+        self._names_size = 0
+        self._load_names()
+
+    def _load_names(self):
+        # дочитываем словарь имён, если его дописали
+        with open(self.path_to_names, 'rb') as file:
+            file.seek(self._names_size)
+            data = file.read()
+        position = 0
+        while position < len(data):
+            length = data[position]
+            if position + 1 + length > len(data):
+                break
+            name = data[position + 1:position + 1 + length].decode('utf-8')
+            self.name_ids.setdefault(name, len(self.names))
+            self.names.append(name)
+            position += 1 + length
+        self._names_size += position
+
+    def _name(self, name_id):
+        if name_id >= len(self.names):
+            self._load_names()
+        return self.names[name_id]
+
+    def _name_id(self, name, new_names):
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            encoded = name.encode('utf-8')
+            if len(encoded) > 255:
+                raise ValueError(f'Name is too long for binary format: {name}')
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+            new_names.append(NAME_LENGTH.pack(len(encoded)) + encoded)
+        return name_id
+
+    def pack_row(self, row, new_names):
+        first_name, last_name, birth_date, phone, document_type, document_id = row
+        return RECORD.pack(self._name_id(first_name, new_names), self._name_id(last_name, new_names),
+                           datetime.date.fromisoformat(birth_date).toordinal(), int(phone),
+                           DOCUMENT_TYPES.index(document_type), int(document_id))
+
+    def unpack_row(self, buffer, offset):
+        first_name, last_name, birth_date, phone, document_type, document_id = RECORD.unpack_from(buffer, offset)
+        return (self._name(first_name), self._name(last_name), datetime.date.fromordinal(birth_date).isoformat(),
+                str(phone), DOCUMENT_TYPES[document_type],
+                str(document_id).zfill(DOCUMENT_ID_LENGTHS[document_type]))
+
+    def _decode(self, field, value):
+        if field in ('first_name', 'last_name'):
+            return self._name(value)
+        if field == 'birth_date':
+            return datetime.date.fromordinal(value).isoformat()
+        if field == 'phone':
+            return str(value)
+        if field == 'document_type':
+            return DOCUMENT_TYPES[value]
+        # номер документа сравниваем числом, ведущие нули зависят от типа
+        return value
+
+    def _map(self):
+        with open(self.path, 'rb') as file:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return (os.path.getsize(self.path) - HEADER.size) // RECORD.size
+
+    def append_rows(self, rows, batch_size=10000):
+        written = 0
+        new_names = []
+        records = []
+        # имена, уже записанные в словарь: при ошибке в пачке новые номера забываем, иначе их раздадут снова
+        committed = len(self.names)
+        try:
+            with open(self.path_to_names, 'ab') as names_file, open(self.path, 'ab') as file:
+                for row in rows:
+                    records.append(self.pack_row(row, new_names))
+                    if len(records) >= batch_size:
+                        written += self._write(names_file, file, new_names, records)
+                        committed = len(self.names)
+                written += self._write(names_file, file, new_names, records)
+                committed = len(self.names)
+        finally:
+            for name in self.names[committed:]:
+                del self.name_ids[name]
+            del self.names[committed:]
+            self._names_size = os.path.getsize(self.path_to_names)
+        return written
+
+    @staticmethod
+    def _write(names_file, file, new_names, records):
+        # имена пишутся раньше записей, которые на них ссылаются
+        names_file.write(b''.join(new_names))
+        names_file.flush()
+        file.write(b''.join(records))
+        written = len(records)
+        new_names.clear()
+        records.clear()
+        return written
+
+    def save_many(self, patients, batch_size=10000):
+        return self.append_rows((patient.as_row() for patient in patients), batch_size)
+
+    def _records(self, start=0):
+        # (память, смещение записи); файл переотображается, когда его дописали во время обхода
+        i = start
+        while True:
+            count = len(self)
+            if i >= count:
+                return
+            with self._map() as memory:
+                view = memoryview(memory)
+                try:
+                    while i < count:
+                        yield view, HEADER.size + i * RECORD.size
+                        i += 1
+                finally:
+                    view.release()
+
+    def rows(self):
+        for view, offset in self._records():
+            yield self.unpack_row(view, offset)
+
+    def column(self, field):
+        # одно поле из каждой записи, остальные не разбираются
+        field_struct, field_offset = FIELD_STRUCTS[field]
+        type_offset = FIELD_STRUCTS['document_type'][1]
+        for view, offset in self._records():
+            value = self._decode(field, field_struct.unpack_from(view, offset + field_offset)[0])
+            if field == 'document_id':
+                value = str(value).zfill(DOCUMENT_ID_LENGTHS[view[offset + type_offset]])
+            yield value
+
+    def row_slice(self, start, stop):
+        stop = min(stop, len(self))
+        if start >= stop:
+            return []
+        with self._map() as memory:
+            return [self.unpack_row(memory, HEADER.size + i * RECORD.size) for i in range(start, stop)]
+
+    def find(self, document_type=None, birth_date_between=None, phone_prefix=None, phone=None, document=None):
+        # сначала разбираются только поля условий; номер документа в записи - число
+        if document is not None:
+            document = (document[0], int(document[1]))
+        checks = [(FIELD_STRUCTS[Patient.fields[position]], Patient.fields[position], check)
+                  for position, check in row_checks(document_type, birth_date_between, phone_prefix, phone, document)]
+        for view, offset in self._records():
+            for (field_struct, field_offset), field, check in checks:
+                if not check(self._decode(field, field_struct.unpack_from(view, offset + field_offset)[0])):
+                    break
+            else:
+                yield self.unpack_row(view, offset)
+
+
+def csv_to_binary(path_to_csv_file, path_to_binary_file, validate=True):
+    rows = PatientCollection(path_to_csv_file, validate=validate).select(*Patient.fields, named=False)
+    return BinaryStorage(path_to_binary_file).append_rows(rows)
+
+
+def binary_to_csv(path_to_binary_file, path_to_csv_file, batch_size=10000):
+    written = 0
+    with open(path_to_csv_file, 'ab') as file:
+        batch = []
+        for row in BinaryStorage(path_to_binary_file).rows():
+            batch.append(row)
+            if len(batch) >= batch_size:
+                file.write(encode_rows(batch))
+                written += len(batch)
+                batch = []
+        file.write(encode_rows(batch))
+    return written + len(batch)
@@ -0,0 +1,19 @@
+"""Сжатие csv с пациентами: остаётся последняя версия каждого документа.
+
+Запуск: python -m homework.compact patients.csv [--with-phone]
+"""
+import argparse
+
+from homework.patient import compact_csv
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', help='csv, который писали Patient.save() и PatientWriter')
+    parser.add_argument('--with-phone', action='store_true', help='разные телефоны считать разными записями')
+    args = parser.parse_args(argv)
+    print(f'{compact_csv(args.path, args.with_phone)} rows removed')
+
+
+if __name__ == '__main__':
+    main()
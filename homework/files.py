@@ -0,0 +1,125 @@
+import csv
+import io
+import os
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # windows: блокировок между процессами нет
+    fcntl = None
+
+READ_BLOCK_SIZE = 1 << 20
+
+
+def encode_rows(rows):
+    # тот же формат строк, что и в Patient.save()
+    buffer = io.StringIO()
+    csv.writer(buffer, delimiter=',').writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+
+class ScanStats:
+    def __init__(self):
+        self.bytes_read = 0
+        self.rows = 0
+        self.seconds = 0.0
+
+    @property
+    def bytes_per_sec(self):
+        return self.bytes_read / self.seconds if self.seconds else 0.0
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return f'{self.rows} rows, {self.bytes_read} bytes in {self.seconds:.3f}s ' \
+               f'({self.rows_per_sec:.0f} rows/s, {self.bytes_per_sec:.0f} B/s)'
+
+
+def read_blocks(path_to_file, block_size=READ_BLOCK_SIZE, start=0, stats=None):
+    # читаем большими блоками, но следующий блок берём только когда строки из предыдущего закончились,
+    # поэтому дописанные во время итерации строки видны, а после обрезания файла read() вернёт пустоту
+    # отдаёт пары (смещение начала первой строки, строки блока без \n)
+    with open(path_to_file, 'rb', buffering=0) as file:
+        file.seek(start)
+        offset = start
+        tail = b''
+        while True:
+            started = time.perf_counter()
+            block = file.read(block_size)
+            if not block:
+                if tail:
+                    # последняя строка без перевода строки
+                    if stats is not None:
+                        stats.rows += 1
+                    yield offset, [tail]
+                break
+            lines = (tail + block).split(b'\n') if tail else block.split(b'\n')
+            tail = lines.pop()
+            if stats is not None:
+                stats.bytes_read += len(block)
+                stats.rows += len(lines)
+                stats.seconds += time.perf_counter() - started
+            if lines:
+                yield offset, lines
+                offset += sum(map(len, lines)) + len(lines)
+
+
+def read_lines(path_to_file, block_size=READ_BLOCK_SIZE, start=0, stats=None):
+    # то же по одной строке: пары (смещение начала строки, строка без \n)
+    for offset, lines in read_blocks(path_to_file, block_size, start, stats):
+        for line in lines:
+            yield offset, line
+            offset += len(line) + 1
+
+
+def encode_row(row):
+    return encode_rows((row,))
+
+
+def split_row(line):
+    # строка файла -> значения полей, \r от csv.writer отрезаем
+    return line.decode('utf-8').rstrip('\r').split(',')
+
+
+def read_line_at(path_to_file, offset):
+    with open(path_to_file, 'rb') as file:
+        file.seek(offset)
+        return file.readline().rstrip(b'\n')
+
+
+def read_range(path_to_file, start, end):
+    with open(path_to_file, 'rb') as file:
+        file.seek(start)
+        return file.read(end - start)
+
+
+def split_ranges(path_to_file, parts):
+    # делит файл на parts кусков примерно одного размера, границы - начала строк
+    with open(path_to_file, 'rb') as file:
+        size = file.seek(0, os.SEEK_END)
+        bounds = [0]
+        for i in range(1, parts):
+            file.seek(max(size * i // parts - 1, bounds[-1]))
+            file.readline()
+            if bounds[-1] < file.tell() < size:
+                bounds.append(file.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+@contextmanager
+def append_lock(file):
+    # flock на время дозаписи: строки разных процессов не перемешиваются, смещение начала известно точно
+    if fcntl is not None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+    try:
+        file.flush()
+        yield file.seek(0, os.SEEK_END)
+        file.flush()
+    finally:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,566 @@
+import hashlib
+import heapq
+import operator
+import os
+import struct
+import tempfile
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import islice
+
+from homework.files import read_lines, read_line_at, append_lock
+
+INDEX_SUFFIX = '.idx'
+OFFSETS_SUFFIX = '.off'
+KEYS_SUFFIX = '.keys'
+KEYS_MAGIC = b'PTNK'
+# заголовок .keys: MAGIC, конец последней учтённой строки csv, конец первой, начало последней, число записей
+KEYS_HEADER = struct.Struct('<4sQQQQ')
+# запись .keys - пара uint64: хэш документа и начало строки csv
+KEY_RECORD_SIZE = 16
+KEYS_FENCE_STEP = 1024
+KEYS_MERGE_ROWS = 10000
+# ключи битой строки в .idx
+NO_KEYS = ('', '', '')
+
+
+def index_path(path_to_csv_file):
+    return path_to_csv_file + INDEX_SUFFIX
+
+
+def offsets_path(path_to_csv_file):
+    return path_to_csv_file + OFFSETS_SUFFIX
+
+
+def keys_path(path_to_csv_file):
+    return path_to_csv_file + KEYS_SUFFIX
+
+
+def _csv_size(path_to_csv_file):
+    try:
+        return os.path.getsize(path_to_csv_file)
+    except FileNotFoundError:
+        return 0
+
+
+def _index_line(start, end, keys):
+    phone, doc_type, doc_id = keys or NO_KEYS
+    return f'{start},{end},{phone},{doc_type},{doc_id}\n'.encode('utf-8')
+
+
+def _last_end(path_to_index):
+    # конец последней проиндексированной строки csv, строки индекса короткие, хватит хвоста
+    with open(path_to_index, 'rb') as file:
+        size = file.seek(0, os.SEEK_END)
+        file.seek(max(0, size - 512))
+        lines = file.read().split(b'\n')
+    if len(lines) < 2:
+        return 0
+    try:
+        return int(lines[-2].split(b',')[1])
+    except (ValueError, IndexError):
+        # индекс испорчен, sync() его пересоберёт
+        return None
+
+
+@contextmanager
+def _csv_lock(path_to_csv_file):
+    # та же блокировка, под которой писатели дописывают csv и вызывают notify_append
+    try:
+        file = open(path_to_csv_file, 'rb')
+    except FileNotFoundError:
+        yield
+        return
+    with file, append_lock(file):
+        yield
+
+
+def _line_ends(path_to_csv_file, start, size):
+    # концы целых строк csv от start до size
+    ends = array('Q')
+    for offset, line in read_lines(path_to_csv_file, start=start):
+        end = offset + len(line) + 1
+        if end > size:
+            break
+        ends.append(end)
+    return ends
+
+
+def _line_at(path_to_csv_file, start, end):
+    # строка csv [start, end) без \n, если на этом месте по-прежнему целая строка, иначе None
+    begin = max(start - 1, 0)
+    try:
+        with open(path_to_csv_file, 'rb') as file:
+            file.seek(begin)
+            data = file.read(end - begin)
+    except FileNotFoundError:
+        return None
+    if start:
+        if data[:1] != b'\n':
+            return None
+        data = data[1:]
+    if len(data) != end - start or data.find(b'\n') != len(data) - 1:
+        return None
+    return data[:-1]
+
+
+def _last_offset(path_to_offsets):
+    with open(path_to_offsets, 'rb') as file:
+        if file.seek(0, os.SEEK_END) < 8:
+            return None
+        file.seek(-8, os.SEEK_END)
+        return array('Q', file.read()).pop()
+
+
+def notify_append(path_to_csv_file, start, entries):
+    """Дописывает в индексы строки, только что добавленные в конец csv.
+
+    entries - пары (длина строки в байтах, ключи). Если индекса ещё нет или он
+    отстал от файла, ничего не делаем: sync() догонит его сам.
+    """
+    path_to_index = index_path(path_to_csv_file)
+    path_to_offsets = offsets_path(path_to_csv_file)
+    update_index = os.path.exists(path_to_index) and _last_end(path_to_index) == start
+    update_offsets = os.path.exists(path_to_offsets) and _last_offset(path_to_offsets) == start
+    if not (update_index or update_offsets):
+        return
+    chunks = []
+    ends = array('Q')
+    for length, keys in entries:
+        chunks.append(_index_line(start, start + length, keys))
+        start += length
+        ends.append(start)
+    if update_index:
+        with open(path_to_index, 'ab') as file:
+            file.write(b''.join(chunks))
+    if update_offsets:
+        with open(path_to_offsets, 'ab') as file:
+            ends.tofile(file)
+
+
+class KeyIndex:
+    """Индекс csv с пациентами по телефону и документу, хранится рядом в файле <csv>.idx.
+
+    Каждая строка индекса - смещения начала и конца строки csv и её нормализованные ключи,
+    row_keys(line) достаёт ключи из строки csv (или None для битой строки).
+    """
+
+    def __init__(self, path_to_csv_file, row_keys):
+        self.path_to_csv_file = path_to_csv_file
+        self.path_to_index = index_path(path_to_csv_file)
+        self.row_keys = row_keys
+        self._reset()
+
+    def _reset(self):
+        self.phones = {}
+        self.documents = {}
+        self.end = 0
+        self._index_size = 0
+        self._index_inode = None
+        # (начало, конец, ключи) первой и последней проиндексированных строк, чтобы заметить переписанный csv
+        self._first = self._last = None
+
+    def _add(self, start, end, keys):
+        phone, doc_type, doc_id = keys or NO_KEYS
+        if phone:
+            self.phones.setdefault(phone, []).append(start)
+            self.documents.setdefault((doc_type, doc_id), []).append(start)
+        self._last = (start, end, (phone, doc_type, doc_id))
+        if self._first is None:
+            self._first = self._last
+        self.end = end
+
+    def _load(self):
+        # дочитываем то, что дописали в индекс другие (например Patient.save())
+        try:
+            with open(self.path_to_index, 'rb') as file:
+                stat = os.fstat(file.fileno())
+                if stat.st_ino != self._index_inode or stat.st_size < self._index_size:
+                    # индекс пересобрал кто-то другой: старое смещение в новом файле ничего не значит
+                    self._reset()
+                    self._index_inode = stat.st_ino
+                file.seek(self._index_size)
+                data = file.read()
+        except FileNotFoundError:
+            self._reset()
+            return False
+        lines = data.split(b'\n')
+        # недописанную строку оставляем на следующий раз
+        self._index_size += len(data) - len(lines.pop())
+        try:
+            for line in lines:
+                start, end, phone, doc_type, doc_id = line.decode('utf-8').split(',')
+                start, end = int(start), int(end)
+                if start != self.end or end <= start:
+                    return False
+                self._add(start, end, (phone, doc_type, doc_id))
+        except ValueError:
+            # строка не разбирается (в том числе UnicodeDecodeError) - индекс испорчен
+            return False
+        return True
+
+    def _entries(self, start, size):
+        # (начало, конец, ключи) целых строк csv от start до size
+        for offset, line in read_lines(self.path_to_csv_file, start=start):
+            end = offset + len(line) + 1
+            if end > size:
+                # строку ещё дописывают
+                break
+            yield offset, end, self.row_keys(line)
+
+    def _append(self, size):
+        entries = list(self._entries(self.end, size))
+        # .idx дописывают и писатели в notify_append под блокировкой csv, поэтому пишем под ней же
+        # и только если за это время индекс никто не продолжил и не пересобрал
+        with _csv_lock(self.path_to_csv_file):
+            try:
+                stale = os.stat(self.path_to_index).st_ino != self._index_inode or \
+                    _last_end(self.path_to_index) != self.end
+            except FileNotFoundError:
+                stale = True
+            if not stale:
+                with open(self.path_to_index, 'ab') as file:
+                    file.write(b''.join(_index_line(*entry) for entry in entries))
+                    index_size = file.tell()
+        if stale:
+            self.sync()
+            return
+        for entry in entries:
+            self._add(*entry)
+        self._index_size = index_size
+
+    def rebuild(self):
+        # собираем во временном файле и подменяем под блокировкой csv; кто держал старый индекс, заметит новый inode
+        size = _csv_size(self.path_to_csv_file)
+        self._reset()
+        directory, name = os.path.split(os.path.abspath(self.path_to_index))
+        with tempfile.NamedTemporaryFile('wb', dir=directory, prefix=name + '.', suffix='.tmp', delete=False) as file:
+            for entry in self._entries(0, size):
+                file.write(_index_line(*entry))
+                self._add(*entry)
+            self._index_size = file.tell()
+            self._index_inode = os.fstat(file.fileno()).st_ino
+        with _csv_lock(self.path_to_csv_file):
+            os.replace(file.name, self.path_to_index)
+
+    def _same_csv(self, size):
+        # первая и последняя проиндексированные строки на своих местах и с теми же ключами
+        if self.end > size:
+            return False
+        for start, end, keys in filter(None, (self._first, self._last)):
+            line = _line_at(self.path_to_csv_file, start, end)
+            if line is None or (self.row_keys(line) or NO_KEYS) != keys:
+                return False
+        return True
+
+    def sync(self):
+        # csv мог поменяться в обход Patient.save(): дописанное доиндексируем, переписанный файл переиндексируем
+        size = _csv_size(self.path_to_csv_file)
+        if not self._load() or not self._same_csv(size):
+            self.rebuild()
+        elif self.end < size:
+            self._append(size)
+
+
+class RowOffsets:
+    """Таблица начал строк csv, хранится рядом в файле <csv>.off как массив uint64.
+
+    offsets[i] - начало i-й строки, последний элемент - конец последней целой строки,
+    так что строк len(offsets) - 1 и любой кусок файла читается одним seek.
+    """
+
+    def __init__(self, path_to_csv_file):
+        self.path_to_csv_file = path_to_csv_file
+        self.path_to_offsets = offsets_path(path_to_csv_file)
+        self.offsets = array('Q', (0,))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def end(self):
+        return self.offsets[-1]
+
+    def _load(self):
+        try:
+            with open(self.path_to_offsets, 'rb') as file:
+                size = file.seek(0, os.SEEK_END) // 8 * 8
+                if size < len(self.offsets) * 8:
+                    self.offsets = array('Q')
+                loaded = len(self.offsets)
+                file.seek(loaded * 8)
+                self.offsets.frombytes(file.read(size - loaded * 8))
+        except FileNotFoundError:
+            return False
+        # начала строк строго растут, иначе файл испорчен (например, один конец дописан дважды)
+        new = self.offsets[max(loaded - 1, 0):]
+        if not all(map(operator.lt, new, new[1:])):
+            return False
+        return len(self.offsets) > 0 and self.offsets[0] == 0
+
+    def _append(self, size):
+        ends = _line_ends(self.path_to_csv_file, self.end, size)
+        # .off дописывают и писатели в notify_append под блокировкой csv, поэтому пишем под ней же
+        # и только если за это время никто не продолжил файл сам
+        with _csv_lock(self.path_to_csv_file):
+            try:
+                extended = _last_offset(self.path_to_offsets) != self.end
+            except FileNotFoundError:
+                extended = True
+            if not extended:
+                with open(self.path_to_offsets, 'ab') as file:
+                    ends.tofile(file)
+        if extended:
+            if not self._load():
+                self.rebuild()
+        else:
+            self.offsets.extend(ends)
+
+    def rebuild(self):
+        offsets = array('Q', (0,))
+        offsets.extend(_line_ends(self.path_to_csv_file, 0, _csv_size(self.path_to_csv_file)))
+        with _csv_lock(self.path_to_csv_file):
+            with open(self.path_to_offsets, 'wb') as file:
+                offsets.tofile(file)
+        self.offsets = offsets
+
+    def _same_csv(self, size):
+        # первая и последняя строки таблицы по-прежнему целые строки csv на тех же местах, как в KeyIndex
+        if self.end > size:
+            return False
+        if not len(self):
+            return True
+        offsets = self.offsets
+        return _line_at(self.path_to_csv_file, offsets[0], offsets[1]) is not None and \
+            _line_at(self.path_to_csv_file, offsets[-2], offsets[-1]) is not None
+
+    def sync(self):
+        size = _csv_size(self.path_to_csv_file)
+        if not self._load() or not self._same_csv(size):
+            self.rebuild()
+        elif self.end < size:
+            self._append(size)
+
+
+def _key_hash(doc_type, doc_id):
+    digest = hashlib.blake2b(f'{doc_type},{doc_id}'.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def _iter_records(file, start, count):
+    # пары (хэш, начало строки) из count записей файла, начиная с байта start
+    offset = start
+    stop = start + count * KEY_RECORD_SIZE
+    while offset < stop:
+        data = os.pread(file.fileno(), min(KEYS_FENCE_STEP * KEY_RECORD_SIZE, stop - offset), offset)
+        if not data:
+            return
+        values = array('Q', data)
+        yield from zip(values[::2], values[1::2])
+        offset += len(data)
+
+
+class KeyFile:
+    """Документы пациентов csv на диске, в файле <csv>.keys, для save(on_conflict=...).
+
+    Записи (хэш документа, начало строки csv) отсортированы по хэшу, в памяти лежит только каждый
+    KEYS_FENCE_STEP-й хэш, так что поиск - чтение одного-двух блоков. Строки, дописанные после сборки
+    файла, держатся в памяти, пока их не наберётся KEYS_MERGE_ROWS, затем сливаются в файл.
+    Совпадение хэша проверяется по самой строке csv. Вызывать под блокировкой дозаписи csv.
+    """
+
+    def __init__(self, path_to_csv_file, row_keys):
+        self.path_to_csv_file = path_to_csv_file
+        self.path_to_keys = keys_path(path_to_csv_file)
+        self.row_keys = row_keys
+        # растёт, когда файл собран заново: закэшированное поверх него могло устареть
+        self.generation = 0
+        self._header = None
+        self._fences = array('Q')
+        self._reset_tail(0, 0, 0)
+
+    def _reset_tail(self, end, first_end, last_start):
+        self._tail = {}
+        self._tail_rows = 0
+        self.end = end
+        self._first_end = first_end
+        self._last_start = last_start
+
+    def _read_header(self):
+        try:
+            with open(self.path_to_keys, 'rb') as file:
+                header = KEYS_HEADER.unpack(file.read(KEYS_HEADER.size))
+        except (FileNotFoundError, struct.error):
+            return None
+        return header if header[0] == KEYS_MAGIC else None
+
+    def _same_csv(self, size):
+        # первая и последняя учтённые строки на своих местах: иначе csv переписали в обход save()
+        if self.end > size:
+            return False
+        if not self.end:
+            return True
+        return _line_at(self.path_to_csv_file, 0, self._first_end) is not None and \
+            _line_at(self.path_to_csv_file, self._last_start, self.end) is not None
+
+    def sync(self):
+        size = _csv_size(self.path_to_csv_file)
+        header = self._read_header()
+        if header is None:
+            self.rebuild(size)
+            return
+        if header != self._header:
+            # файл слил или пересобрал другой процесс
+            self._load(header)
+            self.generation += 1
+        if not self._same_csv(size):
+            self.rebuild(size)
+            return
+        if self.end < size:
+            self._read_tail(size)
+        if self._tail_rows >= KEYS_MERGE_ROWS:
+            self._merge()
+
+    def _load(self, header):
+        _, end, first_end, last_start, count = header
+        with open(self.path_to_keys, 'rb') as file:
+            file.seek(KEYS_HEADER.size + count * KEY_RECORD_SIZE)
+            self._fences = array('Q', file.read())
+        self._header = header
+        self._reset_tail(end, first_end, last_start)
+
+    def _read_tail(self, size, limit=None):
+        for offset, line in read_lines(self.path_to_csv_file, start=self.end):
+            if limit is not None and self._tail_rows >= limit:
+                break
+            end = offset + len(line) + 1
+            if end > size:
+                break
+            keys = self.row_keys(line)
+            if keys:
+                self._tail.setdefault(_key_hash(*keys[1:]), []).append(offset)
+                self._tail_rows += 1
+            if not offset:
+                self._first_end = end
+            self._last_start = offset
+            self.end = end
+
+    def _records(self):
+        if self._header is None:
+            return
+        with open(self.path_to_keys, 'rb') as file:
+            yield from _iter_records(file, KEYS_HEADER.size, self._header[4])
+
+    def _write(self, records):
+        # записи уже отсортированы; пишем во временный файл и подменяем, читатели видят старый или новый целиком
+        tmp_path = self.path_to_keys + '.tmp'
+        fences = array('Q')
+        count = 0
+        with open(tmp_path, 'wb') as file:
+            file.seek(KEYS_HEADER.size)
+            for batch in iter(lambda: list(islice(records, KEYS_FENCE_STEP)), []):
+                fences.append(batch[0][0])
+                file.write(array('Q', (value for record in batch for value in record)).tobytes())
+                count += len(batch)
+            fences.tofile(file)
+            header = (KEYS_MAGIC, self.end, self._first_end, self._last_start, count)
+            file.seek(0)
+            file.write(KEYS_HEADER.pack(*header))
+        os.replace(tmp_path, self.path_to_keys)
+        self._header = header
+        self._fences = fences
+        self._tail = {}
+        self._tail_rows = 0
+
+    def _sorted_tail(self):
+        return sorted((key_hash, start) for key_hash, starts in self._tail.items() for start in starts)
+
+    def _merge(self):
+        self._write(heapq.merge(self._records(), self._sorted_tail()))
+
+    def rebuild(self, size=None):
+        # csv читается кусками по KEYS_MERGE_ROWS строк, каждый сортируется во временный файл, потом они сливаются
+        size = _csv_size(self.path_to_csv_file) if size is None else size
+        self._header = None
+        self._reset_tail(0, 0, 0)
+        self.generation += 1
+        runs = []
+        try:
+            while True:
+                self._tail, self._tail_rows = {}, 0
+                end = self.end
+                self._read_tail(size, KEYS_MERGE_ROWS)
+                if self.end == end:
+                    break
+                run = tempfile.TemporaryFile()
+                array('Q', (value for record in self._sorted_tail() for value in record)).tofile(run)
+                run.flush()
+                runs.append((run, self._tail_rows))
+            self._write(heapq.merge(*(_iter_records(run, 0, count) for run, count in runs)))
+        finally:
+            for run, _ in runs:
+                run.close()
+
+    def _file_starts(self, key_hash):
+        if self._header is None or not self._header[4]:
+            return
+        first = max(bisect_left(self._fences, key_hash) - 1, 0) * KEYS_FENCE_STEP
+        count = self._header[4] - first
+        with open(self.path_to_keys, 'rb') as file:
+            for record_hash, start in _iter_records(file, KEYS_HEADER.size + first * KEY_RECORD_SIZE, count):
+                if record_hash > key_hash:
+                    return
+                if record_hash == key_hash:
+                    yield start
+
+    def contains(self, doc_type, doc_id, phone=None):
+        # есть ли строка с этим документом (и телефоном, если он задан); перед вызовом нужен sync()
+        key_hash = _key_hash(doc_type, doc_id)
+        for start in (*self._file_starts(key_hash), *self._tail.get(key_hash, ())):
+            keys = self.row_keys(read_line_at(self.path_to_csv_file, start))
+            if keys and keys[1:] == (doc_type, doc_id) and (phone is None or keys[0] == phone):
+                return True
+        return False
+
+
+class KeyCache:
+    """Ограниченный LRU-набор ключей уже записанных пациентов перед KeyFile, для save(on_conflict=...).
+
+    Ключ - нормализованные (тип документа, номер) или (тип, номер, телефон). Попадание не читает
+    .keys и csv, промах ищется на диске через KeyFile; найденные и только что записанные ключи
+    кладутся в кэш, старые вытесняются после capacity.
+    """
+
+    def __init__(self, key_file, capacity=100000):
+        self.key_file = key_file
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._keys = OrderedDict()
+        self._generation = key_file.generation
+
+    def __contains__(self, key):
+        self.key_file.sync()
+        if self._generation != self.key_file.generation:
+            self._keys.clear()
+            self._generation = self.key_file.generation
+        if key in self._keys:
+            self.hits += 1
+            self._keys.move_to_end(key)
+            return True
+        self.misses += 1
+        if self.key_file.contains(*key):
+            self.add(key)
+            return True
+        return False
+
+    def add(self, key):
+        self._keys[key] = None
+        self._keys.move_to_end(key)
+        if len(self._keys) > self.capacity:
+            self._keys.popitem(last=False)
+
+    def clear(self):
+        self._keys.clear()
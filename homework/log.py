@@ -1,9 +1,33 @@
+import atexit
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+
+class BatchFileHandler(logging.FileHandler):
+    # в обычном режиме пишет как FileHandler, в фоновом сбрасывает буфер только когда очередь опустела
+    batching = False
+
+    def flush(self):
+        if not self.batching:
+            super().flush()
+
+    def flush_batch(self):
+        logging.FileHandler.flush(self)
+
+
+class BatchQueueListener(QueueListener):
+    def handle(self, record):
+        super().handle(record)
+        if self.queue.empty():
+            for handler in self.handlers:
+                handler.flush_batch()
+
 
 # info_logger_setup
 info_logger = logging.getLogger('Info_Logger')
 info_logger.setLevel(logging.INFO)
-fh_info = logging.FileHandler('info.log', encoding='utf-8')
+fh_info = BatchFileHandler('info.log', encoding='utf-8')
 fh_info.setLevel(logging.INFO)
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 fh_info.setFormatter(formatter)
@@ -12,8 +36,43 @@ info_logger.addHandler(fh_info)
 # error_logger_setup
 error_logger = logging.getLogger('Error_Logger')
 error_logger.setLevel(logging.ERROR)
-fh_error = logging.FileHandler('error.log', encoding='utf-8')
+fh_error = BatchFileHandler('error.log', encoding='utf-8')
 fh_error.setLevel(logging.ERROR)
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 fh_error.setFormatter(formatter)
 error_logger.addHandler(fh_error)
+
+# (logger, файловый handler, handler очереди, слушатель) для фонового режима
+_listeners = []
+
+
+def start_queue_logging():
+    """Переносит запись логов в файлы в фоновые потоки.
+
+    В потоке вызывающего остаётся только форматирование сообщения и постановка в очередь.
+    Файлы не обязаны быть дописаны сразу после вызова логгера, поэтому режим выключен по умолчанию.
+    """
+    if _listeners:
+        return
+    for logger, handler in ((info_logger, fh_info), (error_logger, fh_error)):
+        records = queue.SimpleQueue()
+        queue_handler = QueueHandler(records)
+        listener = BatchQueueListener(records, handler, respect_handler_level=True)
+        handler.batching = True
+        logger.removeHandler(handler)
+        logger.addHandler(queue_handler)
+        listener.start()
+        _listeners.append((logger, handler, queue_handler, listener))
+    atexit.register(stop_queue_logging)
+
+
+def stop_queue_logging():
+    # дописывает всё, что осталось в очередях, и возвращает синхронные handlerы
+    while _listeners:
+        logger, handler, queue_handler, listener = _listeners.pop()
+        listener.stop()
+        logger.removeHandler(queue_handler)
+        handler.batching = False
+        handler.flush()
+        logger.addHandler(handler)
+    atexit.unregister(stop_queue_logging)
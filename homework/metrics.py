@@ -0,0 +1,140 @@
+"""Счётчики и гистограммы задержек для горячих мест: дескрипторы, check_*, save(), обход коллекции.
+
+По умолчанию выключено: в горячих местах остаётся одна проверка metrics.enabled.
+    metrics.enable()
+    ...
+    metrics.snapshot()                     # словарь со всеми значениями
+    metrics.dump_prometheus('metrics.prom')  # текстовый формат Prometheus
+"""
+import os
+import threading
+from bisect import bisect_left
+
+PREFIX = 'patient_'
+# границы корзин в секундах: от микросекунды до секунды
+BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 1e-2, 1e-1, 1.0)
+
+HELP = {
+    'descriptor_set_seconds': 'BaseDescriptor._set latency by field',
+    'check_seconds': 'check_* latency by function',
+    'operation_seconds': 'Latency of save() and full collection scans',
+    'validation_failures_total': 'Rejected values by field and reason',
+    'save_errors_total': 'save() calls that failed, by error',
+    'bytes_written_total': 'Bytes appended to csv files',
+    'bytes_read_total': 'Bytes read by collection scans',
+    'rows_read_total': 'Rows read by collection scans',
+    'scan_rows_per_second': 'Rows per second of the last finished scan',
+}
+
+enabled = False
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+# series -> [счётчики по корзинам + последняя для +Inf, сумма]
+_histograms = {}
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+def _series(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def count(name, value=1, **labels):
+    key = _series(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[_series(name, labels)] = value
+
+
+def observe(name, seconds, **labels):
+    key = _series(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0]
+        histogram[0][bisect_left(BUCKETS, seconds)] += 1
+        histogram[1] += seconds
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format(name, labels, extra=()):
+    labels = labels + tuple(extra)
+    if not labels:
+        return PREFIX + name
+    text = ','.join(f'{key}="{_escape(value)}"' for key, value in labels)
+    return f'{PREFIX}{name}{{{text}}}'
+
+
+def snapshot():
+    """Текущие значения: {'counters': {серия: число}, 'gauges': {...}, 'histograms': {серия: {...}}}.
+
+    Серии записаны как в Prometheus: patient_check_seconds{check="check_phone_value"}.
+    У гистограмм count, sum и накопленные корзины {граница: число}, последняя граница '+Inf'.
+    """
+    with _lock:
+        counters = {_format(*key): value for key, value in _counters.items()}
+        gauges = {_format(*key): value for key, value in _gauges.items()}
+        histograms = {}
+        for key, (buckets, total) in _histograms.items():
+            cumulative, running = {}, 0
+            for bound, number in zip(BUCKETS + ('+Inf',), buckets):
+                running += number
+                cumulative[bound] = running
+            histograms[_format(*key)] = {'count': running, 'sum': total, 'buckets': cumulative}
+    return {'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+
+def prometheus_text():
+    with _lock:
+        series = [(key, 'counter', value) for key, value in _counters.items()] + \
+                 [(key, 'gauge', value) for key, value in _gauges.items()] + \
+                 [(key, 'histogram', (list(buckets), total)) for key, (buckets, total) in _histograms.items()]
+    lines = []
+    described = set()
+    for (name, labels), kind, value in sorted(series, key=lambda item: item[0]):
+        if name not in described:
+            described.add(name)
+            lines.append(f'# HELP {PREFIX}{name} {HELP.get(name, name)}')
+            lines.append(f'# TYPE {PREFIX}{name} {kind}')
+        if kind != 'histogram':
+            lines.append(f'{_format(name, labels)} {value}')
+            continue
+        buckets, total = value
+        running = 0
+        for bound, number in zip(BUCKETS + ('+Inf',), buckets):
+            running += number
+            lines.append(f'{_format(name + "_bucket", labels, (("le", bound),))} {running}')
+        lines.append(f'{_format(name + "_sum", labels)} {total}')
+        lines.append(f'{_format(name + "_count", labels)} {running}')
+    return '\n'.join(lines) + '\n'
+
+
+def dump_prometheus(path):
+    # пишем во временный файл и переименовываем, чтобы node_exporter не прочитал половину
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        file.write(prometheus_text())
+    os.replace(tmp_path, path)
@@ -0,0 +1,225 @@
+import json
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+
+from homework.files import encode_rows, read_lines, split_row, append_lock
+from homework.index import notify_append
+from homework.patient import row_checks
+
+MANIFEST = 'manifest.json'
+LOCK = '.lock'
+YEARS_PER_BUCKET = 10
+# фоновое чтение rows() и head(): не больше READ_AHEAD пачек по BATCH_ROWS строк впереди потребителя
+READ_AHEAD = 4
+BATCH_ROWS = 1000
+# каталоги партиций по типу документа, латиницей
+TYPE_DIRS = {
+    'паспорт': 'passport',
+    'заграничный паспорт': 'international_passport',
+    'водительское удостоверение': 'driver_license',
+}
+
+
+def _find_rows(path, query):
+    # выполняется в процессе пула: одна партиция целиком, наружу только подходящие строки
+    checks = row_checks(**query)
+    return [row for row in _iter_rows(path) if all(check(row[position]) for position, check in checks)]
+
+
+def _iter_rows(path):
+    try:
+        for _, line in read_lines(path):
+            yield split_row(line)
+    except FileNotFoundError:
+        return
+
+
+class PartitionedStorage:
+    """Пациенты в каталоге, разложенные по типу документа и десятилетию рождения: <тип>/<год>.csv.
+
+    В manifest.json для каждой партиции лежат число строк и минимальная и максимальная дата рождения,
+    по ним find() и head() отбрасывают партиции, которые не могут подойти; оставшиеся find() проверяет
+    в пуле процессов, а rows() и head() читают в фоновом потоке. Строки уже нормализованы, порядок - по партициям,
+    внутри партиции - порядок записи. Пул процессов живёт до close().
+    """
+
+    def __init__(self, directory, years_per_bucket=YEARS_PER_BUCKET, workers=None):
+        self.directory = directory
+        self.workers = workers or os.cpu_count()
+        self._executor = None
+        os.makedirs(directory, exist_ok=True)
+        manifest = self.manifest()
+        # размер корзины задаётся при создании каталога и дальше берётся из манифеста
+        self.years_per_bucket = manifest.get('years_per_bucket', years_per_bucket)
+
+    @property
+    def path_to_manifest(self):
+        return os.path.join(self.directory, MANIFEST)
+
+    def manifest(self):
+        try:
+            with open(self.path_to_manifest, encoding='utf-8') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    def partitions(self, document_type=None, birth_date_between=None):
+        # имена партиций (путь относительно каталога) в порядке обхода, без заведомо неподходящих
+        names = []
+        since, until = birth_date_between or (None, None)
+        for name, info in sorted(self.manifest().get('partitions', {}).items()):
+            if not info['rows'] or document_type is not None and info['document_type'] != document_type:
+                continue
+            if since and info['max_birth_date'] < since or until and info['min_birth_date'] > until:
+                continue
+            names.append(name)
+        return names
+
+    def partition_name(self, row):
+        year = int(row[2][:4])
+        bucket = year - year % self.years_per_bucket
+        return f'{TYPE_DIRS[row[4]]}/{bucket}.csv'
+
+    def _path(self, name):
+        return os.path.join(self.directory, *name.split('/'))
+
+    @contextmanager
+    def _locked(self):
+        # один писатель на каталог: строки и манифест меняются вместе
+        with open(os.path.join(self.directory, LOCK), 'ab') as lock_file, append_lock(lock_file):
+            yield
+
+    def append_rows(self, rows, batch_size=10000):
+        rows = iter(rows)
+        written = 0
+        while True:
+            batch = [list(row) for _, row in zip(range(batch_size), rows)]
+            if not batch:
+                return written
+            routed = {}
+            for row in batch:
+                routed.setdefault(self.partition_name(row), []).append(row)
+            with self._locked():
+                manifest = self.manifest()
+                manifest['years_per_bucket'] = self.years_per_bucket
+                partitions = manifest.setdefault('partitions', {})
+                for name, partition_rows in routed.items():
+                    path = self._path(name)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    encoded = [encode_rows((row,)) for row in partition_rows]
+                    with open(path, 'ab') as file, append_lock(file) as start:
+                        file.write(b''.join(encoded))
+                        notify_append(path, start, ((len(line), (row[3], row[4], row[5]))
+                                                    for line, row in zip(encoded, partition_rows)))
+                    dates = [row[2] for row in partition_rows]
+                    info = partitions.setdefault(name, {'document_type': partition_rows[0][4],
+                                                        'bucket': int(name.split('/')[1][:-4]), 'rows': 0,
+                                                        'min_birth_date': min(dates), 'max_birth_date': max(dates)})
+                    info['rows'] += len(partition_rows)
+                    info['min_birth_date'] = min(info['min_birth_date'], *dates)
+                    info['max_birth_date'] = max(info['max_birth_date'], *dates)
+                self._write_manifest(manifest)
+            written += len(batch)
+
+    def _write_manifest(self, manifest):
+        tmp_path = self.path_to_manifest + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(manifest, file, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path_to_manifest)
+
+    def save_many(self, patients, batch_size=10000):
+        return self.append_rows((patient.as_row() for patient in patients), batch_size)
+
+    def _read_ahead(self, names):
+        # партиции читаются в фоновом потоке пачками строк, пока отдаются предыдущие;
+        # целиком партиция в память не попадает, впереди не больше READ_AHEAD пачек
+        batches = queue.Queue(READ_AHEAD)
+        stop = threading.Event()
+        errors = []
+
+        def read():
+            try:
+                for path in map(self._path, names):
+                    rows = _iter_rows(path)
+                    while not stop.is_set():
+                        batch = list(islice(rows, BATCH_ROWS))
+                        if not batch:
+                            break
+                        batches.put(batch)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                batches.put(None)
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        batch = []
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                yield from batch
+        finally:
+            # потребитель мог остановиться раньше (head()): разблокируем поток и ждём его
+            stop.set()
+            while batch is not None:
+                batch = batches.get()
+            reader.join()
+        if errors:
+            raise errors[0]
+
+    def rows(self):
+        return self._read_ahead(self.partitions())
+
+    def head(self, n):
+        # первые n строк: читаем только партиции, которых по манифесту на них хватает
+        partitions = self.manifest().get('partitions', {})
+        names = []
+        total = 0
+        for name in self.partitions():
+            if total >= n:
+                break
+            names.append(name)
+            total += partitions[name]['rows']
+        return islice(self._read_ahead(names), n)
+
+    def find(self, document_type=None, birth_date_between=None, phone_prefix=None, phone=None, document=None):
+        query = dict(document_type=document_type, birth_date_between=birth_date_between, phone_prefix=phone_prefix,
+                     phone=phone, document=document)
+        if document is not None:
+            if document_type is not None and document_type != document[0]:
+                return
+            document_type = document[0]
+        names = self.partitions(document_type, birth_date_between)
+        if len(names) < 2 or self.workers < 2:
+            for name in names:
+                yield from _find_rows(self._path(name), query)
+            return
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers)
+        for future in [self._executor.submit(_find_rows, self._path(name), query) for name in names]:
+            yield from future.result()
+
+    def __len__(self):
+        return sum(info['rows'] for info in self.manifest().get('partitions', {}).values())
+
+    def row_slice(self, start, stop):
+        partitions = self.manifest().get('partitions', {})
+        rows = []
+        first = 0
+        for name in self.partitions():
+            count = partitions[name]['rows']
+            if first + count > start and first < stop:
+                rows.extend(islice(_iter_rows(self._path(name)), max(start - first, 0), stop - first))
+            first += count
+        return rows
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -1,21 +1,43 @@
+import asyncio
 import logging
 import homework.log
+import operator
+import queue
 import re
+import threading
+import time
 import datetime
-import csv
+import os
+import sys
+from array import array
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, FIRST_COMPLETED, wait
 from functools import partial, wraps
-from itertools import islice
+from itertools import islice, compress
+from homework import metrics
+from homework.files import READ_BLOCK_SIZE, ScanStats, read_blocks, read_lines, encode_row, split_row, read_line_at, \
+    read_range, split_ranges, append_lock
+from homework.index import KeyIndex, KeyFile, KeyCache, RowOffsets, notify_append, index_path, offsets_path, \
+    keys_path
+
+
+NAME_WRONG_CHARS = re.compile(r'[^a-zA-Zа-яёА-ЯЁ\s]+')
+SPACES = re.compile(r'\s+')
+DATE_FORMAT = re.compile(r'\d{4}-\d{2}-\d{2}')
+PHONE_WRONG_CHARS = re.compile(r'[^\d()\-+]')
+DOCUMENT_ID_WRONG_CHARS = re.compile(r'[^\d/\-]')
+DIGITS = re.compile(r'\d+')
 
 
 def check_name_value(name: str):
     # дефисы в имени ...
-    if re.search(r'[^a-zA-Zа-яёА-ЯЁ\s]+', name):
+    if NAME_WRONG_CHARS.search(name):
         return False, name
     return True, name.capitalize()
 
 
 def check_date_value(date: str):
-    if re.match(r'\d{4}-\d{2}-\d{2}', re.sub(r'\s+', '', date)) is None:
+    if DATE_FORMAT.match(SPACES.sub('', date)) is None:
         return False, date
     else:
         try:
@@ -26,9 +48,9 @@ def check_date_value(date: str):
 
 
 def check_phone_value(phone: str):
-    if re.search(r'[^\d()\-+]', re.sub(r'\s+', '', phone)):
+    if PHONE_WRONG_CHARS.search(SPACES.sub('', phone)):
         return False, phone
-    phone = ''.join(re.findall(r'\d+', phone))
+    phone = ''.join(DIGITS.findall(phone))
     if len(phone) == 11:
         return True, '7' + phone[1:]
     else:
@@ -43,9 +65,9 @@ def check_document_type_value(doc_type: str, possible_types: frozenset):
 
 
 def check_document_id_value(doc_id: str, doc_type: str):
-    if re.search(r'[^\d/\-]', re.sub(r'\s+', '', doc_id)):
+    if DOCUMENT_ID_WRONG_CHARS.search(SPACES.sub('', doc_id)):
         return False, doc_id
-    doc_id = ''.join(re.findall(r'\d', doc_id))
+    doc_id = ''.join(DIGITS.findall(doc_id))
     if doc_type == 'заграничный паспорт' and len(doc_id) == 9:
         return True, doc_id
     elif doc_type in {'паспорт', 'водительское удостоверение'} and len(doc_id) == 10:
@@ -54,55 +76,214 @@ def check_document_id_value(doc_id: str, doc_type: str):
         return False, doc_id
 
 
+# быстрая нормализация ascii-строк через str.translate, результат тот же, что у check_*_value
+_ASCII_SPACES = ''.join(chr(code) for code in range(128) if chr(code).isspace())
+_PHONE_DELETE = str.maketrans('', '', '()-+' + _ASCII_SPACES)
+_DOCUMENT_ID_DELETE = str.maketrans('', '', '/-' + _ASCII_SPACES)
+
+
+def _batch_phone(phone):
+    if not phone.isascii():
+        return check_phone_value(phone)
+    digits = phone.translate(_PHONE_DELETE)
+    if digits and not digits.isdigit():
+        return False, phone
+    if len(digits) == 11:
+        return True, '7' + digits[1:]
+    return False, digits
+
+
+def _batch_date(date):
+    if not (date.isascii() and len(date) == 10 and date[4] == date[7] == '-'
+            and date[:4].isdigit() and date[5:7].isdigit() and date[8:].isdigit()):
+        return check_date_value(date)
+    try:
+        return True, datetime.date.fromisoformat(date).isoformat()
+    except ValueError:
+        return False, date
+
+
+def _batch_document_id(doc_id, doc_type):
+    if not doc_id.isascii():
+        return check_document_id_value(doc_id, doc_type)
+    digits = doc_id.translate(_DOCUMENT_ID_DELETE)
+    if digits and not digits.isdigit():
+        return False, doc_id
+    if doc_type == 'заграничный паспорт' and len(digits) == 9:
+        return True, digits
+    elif doc_type in {'паспорт', 'водительское удостоверение'} and len(digits) == 10:
+        return True, digits
+    else:
+        return False, digits
+
+
+def _check_column(check, values, *other_columns):
+    if other_columns:
+        return list(map(check, values, *other_columns))
+    # имена, даты и типы документов сильно повторяются, проверяем каждое значение один раз
+    checked = {value: check(value) for value in set(values)}
+    return list(map(checked.__getitem__, values))
+
+
+def validate_batch(columns):
+    """Проверяет и нормализует сразу колонки значений, не падая на первой плохой строке.
+
+    columns - словарь поле -> последовательность значений, для всех или части полей Patient
+    (document_id проверяется только вместе с document_type).
+    Возвращает (нормализованные колонки, ошибки), где ошибки[i] - None для хорошей строки
+    или причина вида 'phone: wrong format' для первого плохого поля.
+    """
+    size = len(next(iter(columns.values()), ()))
+    normalized = {}
+    errors = [None] * size
+    for field in Patient.fields:
+        if field not in columns:
+            continue
+        values = columns[field]
+        if set(map(type, values)) - {str}:
+            values = list(values)
+            for i, value in enumerate(values):
+                if not isinstance(value, str):
+                    values[i] = ''
+                    if errors[i] is None:
+                        errors[i] = f'{field}: must be string'
+        if field in ('first_name', 'last_name'):
+            results = _check_column(check_name_value, values)
+        elif field == 'birth_date':
+            results = _check_column(_batch_date, values)
+        elif field == 'phone':
+            results = list(map(_batch_phone, values))
+        elif field == 'document_type':
+            results = _check_column(partial(check_document_type_value, possible_types=DocumentType.possible_types),
+                                    values)
+        else:
+            results = _check_column(_batch_document_id, values, normalized['document_type'])
+        is_good, normalized[field] = zip(*results) if results else ((), ())
+        for i in compress(range(size), map(operator.not_, is_good)):
+            if errors[i] is None:
+                errors[i] = f'{field}: wrong format'
+    return normalized, errors
+
+
+def validate_rows(rows):
+    # то же для строк целиком: (нормализованные строки или None для плохих, ошибки по строкам)
+    rows = list(rows)
+    whole = [i for i, row in enumerate(rows) if len(row) == len(Patient.fields)]
+    normalized_rows = [None] * len(rows)
+    errors = ['wrong number of fields'] * len(rows)
+    if whole:
+        normalized, batch_errors = validate_batch(dict(zip(Patient.fields, zip(*(rows[i] for i in whole)))))
+        for i, error, row in zip(whole, batch_errors, zip(*map(normalized.get, Patient.fields))):
+            errors[i] = error
+            if error is None:
+                normalized_rows[i] = list(row)
+    return normalized_rows, errors
+
+
+VALIDATE_BATCH_ROWS = 1000
+IO_WORKERS = 4
+_io_executor = None
+
+
+ON_CONFLICT = (None, 'skip', 'replace')
+KEY_CACHE_SIZE = 100000
+_key_caches = {}
+
+
+def key_cache(path_to_file):
+    # один кэш на файл, общий для всех save() процесса; за ним ключи на диске в <csv>.keys
+    cache = _key_caches.get(path_to_file)
+    if cache is None:
+        cache = _key_caches[path_to_file] = KeyCache(KeyFile(path_to_file, row_keys), KEY_CACHE_SIZE)
+    return cache
+
+
+def io_executor():
+    # общий ограниченный пул потоков для блокирующего ввода-вывода из asyncio
+    global _io_executor
+    if _io_executor is None:
+        _io_executor = ThreadPoolExecutor(IO_WORKERS, thread_name_prefix='patient-io')
+    return _io_executor
+
+
 def set_method_logger(func):
     @wraps(func)
     def wrapper(self, instance, value, check_func, able_for_change=True):
         new_value = value
+        started = time.perf_counter() if metrics.enabled else None
         try:
-            func(self, instance, value, check_func, able_for_change)
-            _, new_value = check_func(value)
+            new_value = func(self, instance, value, check_func, able_for_change)
         except TypeError:
-            instance.error_logger.error(f'{value} must by string')
+            _count_failure(started, self.atr_name, 'must be string')
+            instance.error_logger.error('%s must by string', value)
             raise TypeError
         except ValueError:
-            instance.error_logger.error(f'Wrong format : {new_value}')
+            _count_failure(started, self.atr_name, 'wrong format')
+            instance.error_logger.error('Wrong format : %s', new_value)
             raise ValueError
         except AttributeError:
-            instance.error_logger.error(f'Try to set {self.atr_name} of {instance}')
+            _count_failure(started, self.atr_name, 'read only')
+            instance.error_logger.error('Try to set %s of %s', self.atr_name, instance)
             raise AttributeError
         else:
             # не  инициализация, а изменение
-            if instance:
-                instance.info_logger.info(f'For {instance} was set new {self.atr_name} = {new_value}')
+            if instance.info_logger.isEnabledFor(logging.INFO) and instance:
+                instance.info_logger.info('For %s was set new %s = %s', instance, self.atr_name, new_value)
+            if started is not None:
+                metrics.observe('descriptor_set_seconds', time.perf_counter() - started, field=self.atr_name)
 
     return wrapper
 
 
+def _count_failure(started, field, reason):
+    # started is None - метрики были выключены в начале вызова
+    if started is not None:
+        metrics.observe('descriptor_set_seconds', time.perf_counter() - started, field=field)
+        metrics.count('validation_failures_total', field=field, reason=reason)
+
+
+def _timed_check(check_func, value):
+    started = time.perf_counter()
+    result = check_func(value)
+    metrics.observe('check_seconds', time.perf_counter() - started,
+                    check=getattr(check_func, 'func', check_func).__name__)
+    return result
+
+
 def file_method_logger(func):
     @wraps(func)
     def wrapper(self, *args, **kwargs):
+        started = time.perf_counter() if metrics.enabled else None
+        saved = None
         try:
-            func(self, *args, **kwargs)
-        except FileExistsError:
-            self.error_logger.error(f'Raise FileExistsError in save() with {self}')
-        except FileNotFoundError:
-            self.error_logger.error(f'Raise FileNotFoundError in save() with {self}')
-        except IsADirectoryError:
-            self.error_logger.error(f'Raise IsADirectoryError in save() with {self}')
-        except PermissionError:
-            self.error_logger.error(f'Raise PermissionError in save() with {self}')
+            saved = func(self, *args, **kwargs)
+        except (FileExistsError, FileNotFoundError, IsADirectoryError, PermissionError) as error:
+            if started is not None:
+                metrics.count('save_errors_total', error=type(error).__name__)
+            self.error_logger.error('Raise %s in save() with %s', type(error).__name__, self)
         else:
-            self.info_logger.info(f'patient {self} was successfully added to file')
+            if saved:
+                self.info_logger.info('patient %s was successfully added to file', self)
+            else:
+                self.info_logger.info('patient %s is already in file, skipped', self)
+        if started is not None:
+            metrics.observe('operation_seconds', time.perf_counter() - started, operation='save')
+        return saved
 
     return wrapper
 
 
 class BaseDescriptor:
-    def __init__(self, atr_name):
+    def __init__(self, atr_name, slot_name=None):
         self.atr_name = atr_name
+        # для классов со __slots__ значение хранится в слоте, а не в __dict__
+        self.slot_name = slot_name
 
     def __get__(self, instance, owner):
-        value = instance.__dict__.get(self.atr_name)
+        if self.slot_name is None:
+            value = instance.__dict__.get(self.atr_name)
+        else:
+            value = getattr(instance, self.slot_name, None)
         if value:
             return value
         else:
@@ -115,9 +296,13 @@ class BaseDescriptor:
             raise AttributeError
         if not isinstance(value, str):
             raise TypeError
-        is_good, new_value = check_func(value)
+        is_good, new_value = _timed_check(check_func, value) if metrics.enabled else check_func(value)
         if is_good:
-            instance.__dict__[self.atr_name] = new_value
+            if self.slot_name is None:
+                instance.__dict__[self.atr_name] = new_value
+            else:
+                setattr(instance, self.slot_name, new_value)
+            return new_value
         else:
             raise ValueError
 
@@ -159,6 +344,7 @@ class Patient:
     phone = Phone('phone')
     document_type = DocumentType('document_type')
     document_id = DocumentID('document_id')
+    fields = ('first_name', 'last_name', 'birth_date', 'phone', 'document_type', 'document_id')
 
     def __init__(self, first_name, last_name, birth_date, phone, document_type, document_id):
         self.info_logger = logging.getLogger('Info_Logger')
@@ -169,42 +355,965 @@ class Patient:
         self.phone = phone
         self.document_type = document_type
         self.document_id = document_id
-        self.info_logger.info(f'patient {self} was successfully created')
+        self.info_logger.info('patient %s was successfully created', self)
 
     @staticmethod
     def create(*args, **kwargs):
         return Patient(*args, **kwargs)
 
+    @classmethod
+    def from_trusted_row(cls, row):
+        # строки, записанные save(), уже нормализованы, поэтому дескрипторы и логирование пропускаем
+        if len(row) != len(cls.fields):
+            raise ValueError(f'Wrong number of fields in {row}')
+        patient = cls.__new__(cls)
+        patient.info_logger = logging.getLogger('Info_Logger')
+        patient.error_logger = logging.getLogger('Error_Logger')
+        patient.__dict__.update(zip(cls.fields, row))
+        return patient
+
     @file_method_logger
-    def save(self):
-        with open("patients.csv", 'a', encoding='utf-8', newline='') as csv_file:
-            writer = csv.writer(csv_file, delimiter=',')
-            patient = [self.first_name, self.last_name, self.birth_date, self.phone, self.document_type,
-                       self.document_id]
-            writer.writerow(patient)
+    def save(self, storage=None, on_conflict=None, match_phone=False):
+        # on_conflict='skip' - не писать, если этот документ (с match_phone - документ и телефон) уже записан;
+        # 'replace' в csv - дописать новую версию: get_by_* отдают последнюю, но обход, filter() и len() видят
+        # все версии, пока compact_csv() не удалит старые. SqliteStorage.save_row() старые версии удаляет сразу.
+        # Возвращает False, если пациент пропущен
+        if on_conflict not in ON_CONFLICT:
+            raise ValueError(f'on_conflict must be one of {ON_CONFLICT}')
+        phone, doc_type, doc_id = self.keys()
+        if storage is not None:
+            if on_conflict is None:
+                storage.append_rows((self.as_row(),))
+                return True
+            # атомарно проверить и записать умеет только хранилище с save_row()
+            if not hasattr(storage, 'save_row'):
+                raise TypeError(f'on_conflict is not supported by {type(storage).__name__}')
+            return storage.save_row(self.as_row(), on_conflict, match_phone)
+        row = encode_row(self.as_row())
+        with open("patients.csv", 'ab') as csv_file, append_lock(csv_file) as start:
+            if on_conflict == 'skip':
+                # проверка под той же блокировкой, что и запись: другой процесс не впишет ключ между ними
+                cache = key_cache("patients.csv")
+                key = (doc_type, doc_id, phone) if match_phone else (doc_type, doc_id)
+                if key in cache:
+                    return False
+            csv_file.write(row)
+            notify_append("patients.csv", start, ((len(row), self.keys()),))
+            if on_conflict == 'skip':
+                cache.add(key)
+        if metrics.enabled:
+            metrics.count('bytes_written_total', len(row))
+        return True
+
+    async def asave(self, storage=None, on_conflict=None, match_phone=False):
+        return await asyncio.get_running_loop().run_in_executor(
+            io_executor(), partial(self.save, storage, on_conflict, match_phone))
+
+    def as_row(self):
+        return [self.first_name, self.last_name, self.birth_date, self.phone, self.document_type, self.document_id]
+
+    def keys(self):
+        # ключи для поиска по индексу
+        return self.phone, self.document_type, self.document_id
 
     def __str__(self):
         return f'{self.first_name}, {self.last_name}, {self.birth_date}, {self.phone}, {self.document_type},' \
                f' {self.document_id}'
 
     def __bool__(self):
-        # проверка на то все ли инициализированны
-        attrs = filter(lambda atr: not atr.startswith('__'), dir(self))
-        return all((hasattr(self, atr) for atr in attrs))
+        # проверка на то все ли инициализированны, остальные атрибуты из dir() - методы и логгеры
+        return all(hasattr(self, atr) for atr in self.fields)
 
 
-class PatientCollection:
-    def __init__(self, path_to_file):
+class CompactPatient:
+    """Patient без __dict__: поля лежат в слотах, логгеры общие на класс.
+
+    Проверки и логирование те же, что у Patient.
+    """
+    __slots__ = ('_first_name', '_last_name', '_birth_date', '_phone', '_document_type', '_document_id')
+
+    first_name = Name('first_name', '_first_name')
+    last_name = Name('last_name', '_last_name')
+    birth_date = BirthDate('birth_date', '_birth_date')
+    phone = Phone('phone', '_phone')
+    document_type = DocumentType('document_type', '_document_type')
+    document_id = DocumentID('document_id', '_document_id')
+    fields = Patient.fields
+    info_logger = logging.getLogger('Info_Logger')
+    error_logger = logging.getLogger('Error_Logger')
+
+    def __init__(self, first_name, last_name, birth_date, phone, document_type, document_id):
+        self.first_name = first_name
+        self.last_name = last_name
+        self.birth_date = birth_date
+        self.phone = phone
+        self.document_type = document_type
+        self.document_id = document_id
+        self.info_logger.info('patient %s was successfully created', self)
+
+    @classmethod
+    def from_trusted_row(cls, row):
+        if len(row) != len(cls.fields):
+            raise ValueError(f'Wrong number of fields in {row}')
+        patient = cls.__new__(cls)
+        for slot_name, value in zip(cls.__slots__, row):
+            setattr(patient, slot_name, value)
+        return patient
+
+    save = Patient.save
+    as_row = Patient.as_row
+    keys = Patient.keys
+    __str__ = Patient.__str__
+    __bool__ = Patient.__bool__
+
+
+class MemoryPatientCollection:
+    """Пациенты в памяти по колонкам.
+
+    Имена хранятся интернированными строками, дата - порядковым номером дня, телефон и номер
+    документа - числами, тип документа - номером в DOCUMENT_TYPES. Отдаёт CompactPatient.
+    """
+    DOCUMENT_TYPES = tuple(sorted(DocumentType.possible_types))
+    # длина номера документа, чтобы вернуть ведущие нули
+    DOCUMENT_ID_LENGTHS = tuple(9 if doc_type == 'заграничный паспорт' else 10 for doc_type in DOCUMENT_TYPES)
+
+    def __init__(self, patients=()):
+        self.first_names = []
+        self.last_names = []
+        self.birth_dates = array('I')
+        self.phones = array('Q')
+        self.document_types = array('B')
+        self.document_ids = array('Q')
+        self.extend(patients)
+
+    @classmethod
+    def from_collection(cls, collection):
+        memory_collection = cls()
+        memory_collection.extend_rows(collection.select(*Patient.fields, named=False))
+        return memory_collection
+
+    def append_row(self, row):
+        first_name, last_name, birth_date, phone, document_type, document_id = row
+        self.first_names.append(sys.intern(first_name))
+        self.last_names.append(sys.intern(last_name))
+        self.birth_dates.append(datetime.date.fromisoformat(birth_date).toordinal())
+        self.phones.append(int(phone))
+        self.document_types.append(self.DOCUMENT_TYPES.index(document_type))
+        self.document_ids.append(int(document_id))
+
+    def extend_rows(self, rows):
+        for row in rows:
+            self.append_row(row)
+
+    def append(self, patient):
+        self.append_row(patient.as_row())
+
+    def extend(self, patients):
+        for patient in patients:
+            self.append(patient)
+
+    def row(self, i):
+        document_type = self.document_types[i]
+        return (self.first_names[i], self.last_names[i],
+                datetime.date.fromordinal(self.birth_dates[i]).isoformat(), str(self.phones[i]),
+                self.DOCUMENT_TYPES[document_type],
+                str(self.document_ids[i]).zfill(self.DOCUMENT_ID_LENGTHS[document_type]))
+
+    def __len__(self):
+        return len(self.phones)
+
+    def __getitem__(self, i):
+        return CompactPatient.from_trusted_row(self.row(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class PatientWriter:
+    """Пишет пациентов пачками через один открытый файл.
+
+    Строки копятся в памяти и сбрасываются на диск каждые batch_size записей,
+    на каждую пачку пишется одна строка в info.log.
+    """
+
+    def __init__(self, path_to_file, batch_size=1000, fsync=False):
         self.path_to_csv_file = path_to_file
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.written = 0
+        self.info_logger = logging.getLogger('Info_Logger')
+        self.error_logger = logging.getLogger('Error_Logger')
+        self._file = None
+        self._batch = []
+        self._keys = []
+
+    def __enter__(self):
+        try:
+            self._file = open(self.path_to_csv_file, 'ab')
+        except OSError as error:
+            self.error_logger.error('Raise %s in PatientWriter for %s', type(error).__name__, self.path_to_csv_file)
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self.flush()
+        finally:
+            self._file.close()
+            self._file = None
+
+    def write(self, patient):
+        self._batch.append(encode_row(patient.as_row()))
+        self._keys.append(patient.keys())
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def write_many(self, patients):
+        for patient in patients:
+            self.write(patient)
+
+    def write_rows(self, rows):
+        # сырые строки импорта: проверяются пачкой, пишутся только хорошие, возвращаются (номер, причина) плохих
+        errors = []
+        normalized_rows, row_errors = validate_rows(rows)
+        for i, (row, error) in enumerate(zip(normalized_rows, row_errors)):
+            if error is not None:
+                errors.append((i, error))
+                continue
+            self._batch.append(encode_row(row))
+            self._keys.append(tuple(row[3:]))
+            if len(self._batch) >= self.batch_size:
+                self.flush()
+        return errors
+
+    def flush(self):
+        if not self._batch:
+            return
+        commit(self._file, self.path_to_csv_file, self._batch, self._keys, self.fsync)
+        self.written += len(self._batch)
+        self.info_logger.info('%s patients were successfully added to %s', len(self._batch), self.path_to_csv_file)
+        self._batch = []
+        self._keys = []
+
+
+def commit(file, path_to_file, rows, keys, fsync=False):
+    # закодированные строки одной записью под блокировкой, вместе с обновлением индексов
+    with append_lock(file) as start:
+        file.write(b''.join(rows))
+        file.flush()
+        if fsync:
+            os.fsync(file.fileno())
+        notify_append(path_to_file, start, zip(map(len, rows), keys))
+
+
+class GroupCommitWriter:
+    """Общий писатель для многих потоков: строки, пришедшие за max_latency секунд, пишутся одной пачкой.
+
+    На пачку - один write и один fsync под flock, поэтому строки не рвутся и не перемешиваются
+    и при записи из нескольких процессов (у каждого свой GroupCommitWriter).
+    save() ждёт, пока пачка с пациентом окажется на диске, submit() сразу возвращает Future.
+    """
+
+    def __init__(self, path_to_file, max_latency=0.005, max_batch=1000, fsync=True):
+        self.path_to_csv_file = path_to_file
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+        self.fsync = fsync
+        self.info_logger = logging.getLogger('Info_Logger')
+        self.error_logger = logging.getLogger('Error_Logger')
+        self._queue = queue.Queue()
+        self._closed = False
+        # submit() и close() под одной блокировкой: после close() в очередь ничего не попадёт
+        self._lock = threading.Lock()
+        self._file = open(path_to_file, 'ab')
+        self._thread = threading.Thread(target=self._run, name='GroupCommitWriter', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit(self, patient):
+        future = Future()
+        item = (encode_row(patient.as_row()), patient.keys(), future)
+        with self._lock:
+            if self._closed:
+                raise ValueError('GroupCommitWriter is closed')
+            self._queue.put(item)
+        return future
+
+    def save(self, patient):
+        return self.submit(patient).result()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+
+    def _commit(self, batch):
+        rows, keys, futures = zip(*batch)
+        try:
+            commit(self._file, self.path_to_csv_file, rows, keys, self.fsync)
+        except Exception as error:
+            # любая ошибка достаётся ожидающим, а поток продолжает писать следующие пачки
+            self.error_logger.error('Raise %s in GroupCommitWriter for %s', type(error).__name__,
+                                    self.path_to_csv_file)
+            for future in futures:
+                future.set_exception(error)
+        else:
+            self.info_logger.info('%s patients were successfully added to %s', len(rows), self.path_to_csv_file)
+            for future in futures:
+                future.set_result(None)
+
+
+class AsyncPatientWriter:
+    """GroupCommitWriter для asyncio: await write(patient) возвращается, когда строка на диске.
+
+    Записи от всех корутин собираются в общие пачки, а не больше max_pending записей ждут
+    одновременно - остальные корутины ждут в write(). Логирование лучше перевести в фон
+    через homework.log.start_queue_logging(), иначе создание пациентов пишет в файл из цикла событий.
+    """
+
+    def __init__(self, path_to_file, max_pending=1000, max_latency=0.005, max_batch=1000, fsync=True):
+        self._writer = GroupCommitWriter(path_to_file, max_latency, max_batch, fsync)
+        self._pending = asyncio.Semaphore(max_pending)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+
+    async def write(self, patient):
+        async with self._pending:
+            await asyncio.wrap_future(self._writer.submit(patient))
+
+    async def write_many(self, patients):
+        await asyncio.gather(*map(self.write, patients))
+
+    async def aclose(self):
+        await asyncio.get_running_loop().run_in_executor(io_executor(), self._writer.close)
+
+
+def row_keys(line):
+    # нормализованные (телефон, тип документа, номер документа) строки csv или None, если строка битая
+    try:
+        _, _, _, phone, doc_type, doc_id = split_row(line)
+    except ValueError:
+        return None
+    is_good_phone, phone = check_phone_value(phone)
+    is_good_type, doc_type = check_document_type_value(doc_type, DocumentType.possible_types)
+    is_good_id, doc_id = check_document_id_value(doc_id, doc_type)
+    if is_good_phone and is_good_type and is_good_id:
+        return phone, doc_type, doc_id
+    return None
+
+
+def compact_csv(path_to_file, with_phone=False):
+    """Переписывает csv, оставляя только последнюю версию каждого документа (с with_phone - документа и телефона).
+
+    Битые строки не трогаем. Файл переписывается на месте под блокировкой дозаписи, поэтому save()
+    из других процессов ждут и допишут уже в сжатый файл. До копирования сжатое содержимое
+    целиком ложится в <csv>.compact; если копирование прервалось, следующий вызов сначала докопирует его,
+    сохранив строки, дописанные после падения.
+    Индексы .idx, .off и .keys после сжатия удаляются и пересобираются при следующем обращении.
+    Возвращает число удалённых строк.
+    """
+    tmp_path = path_to_file + '.compact'
+    with open(path_to_file, 'r+b') as csv_file, append_lock(csv_file) as size:
+        if os.path.exists(tmp_path):
+            size = _finish_compaction(csv_file, path_to_file, tmp_path)
+        if os.path.exists(tmp_path + '.tmp'):
+            # упали, не дописав сжатую копию: csv ещё не трогали
+            os.remove(tmp_path + '.tmp')
+        latest = {}
+        keys = []
+        for offset, line in read_lines(path_to_file):
+            line_keys = row_keys(line)
+            key = None
+            if line_keys is not None:
+                phone, doc_type, doc_id = line_keys
+                key = (doc_type, doc_id, phone) if with_phone else (doc_type, doc_id)
+                latest[key] = offset
+            keys.append(key)
+        dropped = len(keys) - sum(key is None for key in keys) - len(latest)
+        if not dropped:
+            return 0
+        # первая строка - размер csv до сжатия, по нему после падения видно, что дописали позже
+        with open(tmp_path + '.tmp', 'wb') as tmp_file:
+            tmp_file.write(b'%d\n' % size)
+            for (offset, line), key in zip(read_lines(path_to_file), keys):
+                if key is None or latest[key] == offset:
+                    tmp_file.write(line + b'\n')
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        # <csv>.compact появляется только целиком
+        os.replace(tmp_path + '.tmp', tmp_path)
+        with open(tmp_path, 'rb') as tmp_file:
+            tmp_file.readline()
+            _copy_back(tmp_file, csv_file)
+        _drop_sidecars(path_to_file)
+    return dropped
+
+
+def _copy_back(tmp_file, csv_file, tail=b''):
+    csv_file.seek(0)
+    while True:
+        block = tmp_file.read(READ_BLOCK_SIZE)
+        if not block:
+            break
+        csv_file.write(block)
+    csv_file.write(tail)
+    csv_file.truncate()
+    csv_file.flush()
+    os.fsync(csv_file.fileno())
+
+
+def _finish_compaction(csv_file, path_to_file, tmp_path):
+    # прошлое сжатие упало, не докопировав <csv>.compact; возвращает новый размер csv
+    with open(tmp_path, 'rb') as tmp_file:
+        size_before = int(tmp_file.readline())
+        start = tmp_file.tell()
+        compacted_size = tmp_file.seek(0, os.SEEK_END) - start
+        size = csv_file.seek(0, os.SEEK_END)
+        # пока файл не обрезан, он не короче исходного и дописанное идёт после size_before,
+        # после обрезания - сразу за сжатым содержимым
+        csv_file.seek(size_before if size >= size_before else compacted_size)
+        tail = csv_file.read()
+        tmp_file.seek(start)
+        _copy_back(tmp_file, csv_file, tail)
+    _drop_sidecars(path_to_file)
+    return compacted_size + len(tail)
+
+
+def _drop_sidecars(path_to_file):
+    for path in (index_path(path_to_file), offsets_path(path_to_file), keys_path(path_to_file),
+                 path_to_file + '.compact'):
+        if os.path.exists(path):
+            os.remove(path)
+    _key_caches.pop(path_to_file, None)
+
+
+def _parse_range(path_to_file, start, end, fn, validate):
+    # выполняется в процессе пула
+    lines = read_range(path_to_file, start, end).split(b'\n')
+    if not lines[-1]:
+        lines.pop()
+    collection = PatientCollection(path_to_file, validate=validate)
+    patients = map(collection._patient, lines)
+    return list(patients if fn is None else map(fn, patients))
+
+
+class PatientFollower:
+    """Отдаёт пациентов по мере дописывания csv, как tail -F.
+
+    offset - байт, до которого файл уже прочитан, его можно сохранить и потом продолжить с
+    него через PatientCollection.follow(from_offset=...), не перечитывая файл. Если файл
+    обрезали или заменили другим (ротация), чтение начинается с начала нового файла.
+    Без idle_timeout итерация бесконечна, иначе заканчивается после стольких секунд без новых строк.
+    """
+
+    def __init__(self, collection, from_offset=0, poll_interval=1.0, idle_timeout=None, inode=None):
+        self.collection = collection
+        self.offset = from_offset
+        self.inode = inode
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.restarts = 0
+        self._patients = self._follow()
 
     def __iter__(self):
-        with open(self.path_to_csv_file, 'rb', buffering=0) as file:
-            while True:
-                line = file.readline()
-                if not line:
+        return self
+
+    def __next__(self):
+        return next(self._patients)
+
+    def checkpoint(self):
+        return {'from_offset': self.offset, 'inode': self.inode}
+
+    def _follow(self):
+        path = self.collection.path_to_csv_file
+        idle_since = time.monotonic()
+        while True:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stat = None
+            if stat is not None:
+                if self.inode not in (None, stat.st_ino) or stat.st_size < self.offset:
+                    self.offset = 0
+                    self.restarts += 1
+                self.inode = stat.st_ino
+                if stat.st_size > self.offset:
+                    start = self.offset
+                    for offset, line in read_lines(path, self.collection.block_size, start=self.offset):
+                        end = offset + len(line) + 1
+                        if end > stat.st_size:
+                            # строку ещё дописывают
+                            break
+                        self.offset = end
+                        yield self.collection._patient(line)
+                    if self.offset > start:
+                        idle_since = time.monotonic()
+                        continue
+                    # только недописанная строка: ждём, как будто новых строк нет
+            if self.idle_timeout is not None and time.monotonic() - idle_since >= self.idle_timeout:
+                return
+            time.sleep(self.poll_interval)
+
+
+# проверки полей строки csv по их номерам, для filter() и select(), номер документа проверяется отдельно
+ROW_CHECKS = {
+    0: check_name_value,
+    1: check_name_value,
+    2: check_date_value,
+    3: check_phone_value,
+    4: partial(check_document_type_value, possible_types=DocumentType.possible_types),
+}
+
+
+def row_checks(document_type=None, birth_date_between=None, phone_prefix=None, phone=None, document=None):
+    """Условия PatientCollection.filter() как список (номер поля в строке, проверка значения).
+
+    Условия уже нормализованы PatientCollection._query(), значения полей тоже,
+    так что этим же списком пользуются хранилища для своих find().
+    """
+    checks = []
+    if document_type is not None:
+        checks.append((4, lambda value: value == document_type))
+    if birth_date_between is not None:
+        since, until = birth_date_between
+        checks.append((2, lambda value: (not since or value >= since) and (not until or value <= until)))
+    if phone_prefix is not None:
+        checks.append((3, lambda value: value.startswith(phone_prefix)))
+    if phone is not None:
+        checks.append((3, lambda value: value == phone))
+    if document is not None:
+        checks.append((4, lambda value: value == document[0]))
+        checks.append((5, lambda value: value == document[1]))
+    return checks
+
+
+def _record_scan(stats, seconds):
+    # seconds - весь обход вместе с разбором и проверками, в stats.seconds только чтение файла
+    metrics.count('bytes_read_total', stats.bytes_read)
+    metrics.count('rows_read_total', stats.rows)
+    metrics.observe('operation_seconds', seconds, operation='scan')
+    metrics.set_gauge('scan_rows_per_second', stats.rows / seconds if seconds else 0.0)
+
+
+class PatientCollection:
+    def __init__(self, path_to_file, block_size=READ_BLOCK_SIZE, validate=True):
+        # validate=False только для файлов, которые писали Patient.save() и PatientWriter
+        # вместо пути можно передать хранилище, например storage.SqliteStorage,
+        # путь к каталогу открывается как partitioned.PartitionedStorage, файл .csvz - как archive.ArchiveStorage
+        # хранилище, открытое по пути, закрывает close(); переданное снаружи закрывает тот, кто его создал
+        self._owns_storage = False
+        if isinstance(path_to_file, (str, os.PathLike)) and os.path.isdir(path_to_file):
+            from homework.partitioned import PartitionedStorage  # модуль сам импортирует patient
+            path_to_file = PartitionedStorage(path_to_file)
+            self._owns_storage = True
+        elif isinstance(path_to_file, (str, os.PathLike)) and os.fspath(path_to_file).endswith('.csvz'):
+            from homework.archive import ArchiveStorage
+            path_to_file = ArchiveStorage(path_to_file)
+            self._owns_storage = True
+        if isinstance(path_to_file, (str, os.PathLike)):
+            self.path_to_csv_file = path_to_file
+            self.storage = None
+        else:
+            self.path_to_csv_file = None
+            self.storage = path_to_file
+        self.block_size = block_size
+        self.validate = validate
+        self.last_scan = None
+        self._key_index = None
+        self._row_offsets = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._owns_storage and hasattr(self.storage, 'close'):
+            self.storage.close()
+
+    def __iter__(self):
+        if self.storage is not None:
+            yield from map(self._patient_row, self.storage.rows())
+            return
+        self.last_scan = ScanStats()
+        started = time.perf_counter() if metrics.enabled else None
+        try:
+            if self.validate:
+                yield from self._validated(read_blocks(self.path_to_csv_file, self.block_size, stats=self.last_scan))
+            else:
+                for _, line in read_lines(self.path_to_csv_file, self.block_size, stats=self.last_scan):
+                    yield self._patient(line)
+        finally:
+            if started is not None:
+                _record_scan(self.last_scan, time.perf_counter() - started)
+
+    @staticmethod
+    def _validated(blocks):
+        # проверяем пачками по колонкам и собираем пациентов без дескрипторов; пачки не выходят за прочитанный блок,
+        # чтобы дописанные во время обхода строки были видны. Плохую строку отдаём Patient(*row):
+        # он бросит то же исключение и запишет ту же ошибку в лог
+        for _, lines in blocks:
+            for first in range(0, len(lines), VALIDATE_BATCH_ROWS):
+                batch = list(map(split_row, lines[first:first + VALIDATE_BATCH_ROWS]))
+                normalized, _ = validate_rows(batch)
+                for row, good_row in zip(batch, normalized):
+                    yield Patient(*row) if good_row is None else Patient.from_trusted_row(good_row)
+
+    def _patient(self, line):
+        return self._patient_row(split_row(line))
+
+    def _patient_row(self, row):
+        return Patient(*row) if self.validate else Patient.from_trusted_row(row)
+
+    def key_index(self):
+        if self._key_index is None:
+            self._key_index = KeyIndex(self.path_to_csv_file, row_keys)
+        self._key_index.sync()
+        return self._key_index
+
+    def rebuild_index(self):
+        if self._key_index is None:
+            self._key_index = KeyIndex(self.path_to_csv_file, row_keys)
+        self._key_index.rebuild()
+
+    def _lookup(self, find_offsets, matches):
+        for _ in range(2):
+            offsets = find_offsets(self.key_index())
+            if not offsets:
+                return None
+            line = read_line_at(self.path_to_csv_file, offsets[-1])
+            keys = row_keys(line)
+            if keys and matches(keys):
+                return self._patient(line)
+            # файл переписали на месте, индекс устарел
+            self._key_index.rebuild()
+        return None
+
+    def _last_found(self, **query):
+        row = None
+        for row in self.storage.find(**query):
+            pass
+        return row and self._patient_row(row)
+
+    def get_by_phone(self, phone):
+        is_good, phone = check_phone_value(phone)
+        if not is_good:
+            return None
+        if self.storage is not None:
+            return self._last_found(phone=phone)
+        return self._lookup(lambda index: index.phones.get(phone), lambda keys: keys[0] == phone)
+
+    def get_by_document(self, doc_type, doc_id):
+        is_good_type, doc_type = check_document_type_value(doc_type, DocumentType.possible_types)
+        is_good_id, doc_id = check_document_id_value(doc_id, doc_type)
+        if not (is_good_type and is_good_id):
+            return None
+        key = (doc_type, doc_id)
+        if self.storage is not None:
+            return self._last_found(document=key)
+        return self._lookup(lambda index: index.documents.get(key), lambda keys: keys[1:] == key)
+
+    def row_offsets(self):
+        if self._row_offsets is None:
+            self._row_offsets = RowOffsets(self.path_to_csv_file)
+        self._row_offsets.sync()
+        return self._row_offsets
+
+    def __getitem__(self, item):
+        count = len(self.storage) if self.storage is not None else len(self.row_offsets())
+        if isinstance(item, slice):
+            positions = range(*item.indices(count))
+        else:
+            if item < 0:
+                item += count
+            if not 0 <= item < count:
+                raise IndexError('patient index out of range')
+            positions = range(item, item + 1)
+        if not positions:
+            return []
+        first = min(positions)
+        rows = self._rows_between(first, max(positions) + 1)
+        patients = [self._patient_row(rows[i - first]) for i in positions]
+        return patients if isinstance(item, slice) else patients[0]
+
+    def _rows_between(self, start, stop):
+        if self.storage is not None:
+            return self.storage.row_slice(start, stop)
+        offsets = self._row_offsets.offsets
+        lines = read_range(self.path_to_csv_file, offsets[start], offsets[stop]).split(b'\n')
+        return [split_row(line) for line in lines[:-1]]
+
+    def page(self, offset, size):
+        return self[offset:offset + size]
+
+    def filter(self, document_type=None, birth_date_between=None, phone_prefix=None, phone=None, document=None):
+        """Пациенты, подходящие под все заданные условия, в порядке файла.
+
+        Условия проверяются на сырых полях строки, Patient создаётся только для подходящих строк.
+        birth_date_between - пара дат включительно (любую можно не задавать). phone_prefix начинается
+        с кода страны: '8 (903)' или '7903', а не '903'. Если задан phone
+        или document=(тип, номер), строки берутся через индекс, а не полным проходом по файлу.
+        """
+        query = self._query(document_type, birth_date_between, phone_prefix, phone, document)
+        if query is None:
+            return
+        rows = self.storage.find(**query) if self.storage is not None else self._filter_rows(**query)
+        for row in rows:
+            yield self._patient_row(row)
+
+    @staticmethod
+    def _query(document_type, birth_date_between, phone_prefix, phone, document):
+        # нормализованные условия filter() или None, если точный ключ заведомо не найдётся
+        if document_type is not None:
+            document_type = document_type.lower()
+        if birth_date_between is not None:
+            birth_date_between = tuple(date and check_date_value(date)[1] for date in birth_date_between)
+        if phone_prefix is not None:
+            # телефоны хранятся с 7 в начале, 8 как код страны приводим к ней же
+            phone_prefix = ''.join(DIGITS.findall(phone_prefix))
+            if phone_prefix.startswith('8'):
+                phone_prefix = '7' + phone_prefix[1:]
+        if phone is not None:
+            is_good, phone = check_phone_value(phone)
+            if not is_good:
+                return None
+        if document is not None:
+            is_good_type, doc_type = check_document_type_value(document[0], DocumentType.possible_types)
+            is_good_id, doc_id = check_document_id_value(document[1], doc_type)
+            if not (is_good_type and is_good_id):
+                return None
+            document = (doc_type, doc_id)
+        return dict(document_type=document_type, birth_date_between=birth_date_between, phone_prefix=phone_prefix,
+                    phone=phone, document=document)
+
+    def _filter_rows(self, document_type, birth_date_between, phone_prefix, phone, document):
+        # телефон и документ отбирает индекс, остальное проверяется на строках
+        checks = row_checks(document_type, birth_date_between, phone_prefix)
+        if phone is None and document is None:
+            lines = (line for _, line in read_lines(self.path_to_csv_file, self.block_size))
+        else:
+            lines = self._indexed_lines(phone, document)
+        for line in lines:
+            row = split_row(line)
+            if self._matches(row, checks):
+                yield row
+
+    def select(self, *columns, named=True):
+        """Только нужные колонки строк файла, namedtuple PatientRow или обычные кортежи.
+
+        Patient не создаётся, декодируются и проверяются только запрошенные поля.
+        """
+        positions = [Patient.fields.index(column) for column in columns]
+        make_row = namedtuple('PatientRow', columns)._make if named else tuple
+        last = len(Patient.fields) - 1
+        if self.storage is not None:
+            for row in self.storage.rows():
+                values = [row[position] for position in positions]
+                if self.validate:
+                    values = [self._check_column(position, value, row[4]) for position, value in zip(positions, values)]
+                yield make_row(values)
+            return
+        if not self.validate or not positions:
+            for _, line in read_lines(self.path_to_csv_file, self.block_size):
+                yield make_row(self._selected(line, positions, False))
+            return
+        selected = [Patient.fields[position] for position in positions]
+        checked = set(selected) | ({'document_type'} if last in positions else set())
+        batches = (lines[first:first + VALIDATE_BATCH_ROWS]
+                   for _, lines in read_blocks(self.path_to_csv_file, self.block_size)
+                   for first in range(0, len(lines), VALIDATE_BATCH_ROWS))
+        for batch in batches:
+            rows = []
+            for line in batch:
+                row = split_row(line)
+                if len(row) != len(Patient.fields):
                     break
-                yield Patient(*line.decode('utf-8').split(','))
+                rows.append(row)
+            normalized, errors = validate_batch({field: [row[Patient.fields.index(field)] for row in rows]
+                                                 for field in checked})
+            for i, (line, error) in enumerate(zip(batch, errors)):
+                # плохую строку проверяем по одному значению: та же ошибка, что и без пачек
+                yield make_row(self._selected(line, positions, True) if error is not None
+                               else [normalized[field][i] for field in selected])
+            if len(rows) < len(batch):
+                raise ValueError(f'Wrong format : {batch[len(rows)]}')
+
+    @classmethod
+    def _selected(cls, line, positions, validate):
+        fields = line.split(b',')
+        if len(fields) != len(Patient.fields):
+            raise ValueError(f'Wrong format : {line}')
+        last = len(Patient.fields) - 1
+        values = [fields[position].decode('utf-8') for position in positions]
+        if last in positions:
+            values[positions.index(last)] = values[positions.index(last)].rstrip('\r')
+        if validate:
+            doc_type = fields[4].decode('utf-8') if last in positions else None
+            values = [cls._check_column(position, value, doc_type) for position, value in zip(positions, values)]
+        return values
+
+    @staticmethod
+    def _check_column(position, value, doc_type):
+        if position in ROW_CHECKS:
+            is_good, new_value = ROW_CHECKS[position](value)
+        else:
+            # номер документа зависит от типа
+            is_good, new_value = check_document_id_value(value, ROW_CHECKS[4](doc_type)[1])
+        if not is_good:
+            raise ValueError(f'Wrong format : {value}')
+        return new_value
+
+    def _matches(self, row, checks):
+        if len(row) != len(Patient.fields):
+            return False
+        for position, check in checks:
+            value = row[position]
+            if self.validate:
+                is_good, value = ROW_CHECKS[position](value)
+                if not is_good:
+                    return False
+            if not check(value):
+                return False
+        return True
+
+    def _indexed_lines(self, phone, document):
+        index = self.key_index()
+        found = []
+        if phone is not None:
+            found.append(set(index.phones.get(phone, ())))
+        if document is not None:
+            found.append(set(index.documents.get(document, ())))
+        for offset in sorted(set.intersection(*found)):
+            line = read_line_at(self.path_to_csv_file, offset)
+            # на случай, если файл переписали на месте
+            keys = row_keys(line)
+            if keys and phone in (None, keys[0]) and document in (None, keys[1:]):
+                yield line
+
+    def find_errors(self, batch_size=10000):
+        # (номер строки, причина) для всех плохих строк файла, без создания пациентов
+        errors = []
+        rows = (split_row(line) for _, line in read_lines(self.path_to_csv_file, self.block_size))
+        first = 0
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                return errors
+            _, batch_errors = validate_rows(batch)
+            errors.extend((first + i, error) for i, error in enumerate(batch_errors) if error is not None)
+            first += len(batch)
+
+    def scan_stats(self):
+        # скорость самого чтения, без создания пациентов
+        stats = ScanStats()
+        for _ in read_lines(self.path_to_csv_file, self.block_size, stats=stats):
+            pass
+        return stats
+
+    def parallel_map(self, fn=None, workers=None, ordered=True, chunks_per_worker=4):
+        """Разбирает файл в пуле процессов и отдаёт fn(patient) для каждой строки.
+
+        Файл режется на куски по границам строк, fn должна пиклиться. При ordered=False
+        результаты идут кусками в порядке готовности, а не в порядке файла.
+        """
+        workers = workers or os.cpu_count()
+        ranges = iter(split_ranges(self.path_to_csv_file, workers * chunks_per_worker))
+        executor = ProcessPoolExecutor(workers)
+
+        def submit(count):
+            return [executor.submit(_parse_range, self.path_to_csv_file, start, end, fn, self.validate)
+                    for start, end in islice(ranges, count)]
+
+        try:
+            # в работе не больше двух кусков на процесс: готовые результаты не копятся, если их медленно забирают,
+            # а следующий кусок отправляется, как только забрали предыдущий
+            if ordered:
+                pending = deque(submit(2 * workers))
+                while pending:
+                    result = pending.popleft().result()
+                    pending.extend(submit(1))
+                    yield from result
+            else:
+                pending = set(submit(2 * workers))
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    pending.update(submit(len(done)))
+                    for future in done:
+                        yield from future.result()
+        finally:
+            # при досрочном выходе неначатые куски не разбираем
+            executor.shutdown(cancel_futures=True)
+
+    def load(self, workers=None):
+        return list(self.parallel_map(workers=workers))
+
+    async def aiter(self, batch_size=1000):
+        # чтение и разбор идут пачками в пуле потоков, следующая пачка готовится, пока обрабатывается текущая
+        loop = asyncio.get_running_loop()
+        patients = iter(self)
+        batch = await loop.run_in_executor(io_executor(), list, islice(patients, batch_size))
+        while batch:
+            next_batch = loop.run_in_executor(io_executor(), list, islice(patients, batch_size))
+            for patient in batch:
+                yield patient
+            batch = await next_batch
+
+    def follow(self, from_offset=0, poll_interval=1.0, idle_timeout=None, inode=None):
+        return PatientFollower(self, from_offset, poll_interval, idle_timeout, inode)
 
     def limit(self, n):
+        if self.storage is not None and hasattr(self.storage, 'head'):
+            # хранилище само знает, сколько строк где лежит, и не читает лишнего
+            return map(self._patient_row, self.storage.head(n))
         # наверно более красиво, очевидно и по питоняче
         return islice(self, n)
+
+    def compact(self, with_phone=False):
+        if self.storage is not None:
+            raise TypeError('compact() works only with csv files')
+        dropped = compact_csv(self.path_to_csv_file, with_phone)
+        if dropped:
+            self._key_index = None
+            self._row_offsets = None
+        return dropped
+
+    def save_many(self, patients, batch_size=1000, fsync=False):
+        if self.storage is not None:
+            return self.storage.save_many(patients, batch_size)
+        with PatientWriter(self.path_to_csv_file, batch_size, fsync) as writer:
+            writer.write_many(patients)
+        return writer.written
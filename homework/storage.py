@@ -0,0 +1,142 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+FIELDS = ('first_name', 'last_name', 'birth_date', 'phone', 'document_type', 'document_id')
+COLUMNS = ', '.join(FIELDS)
+
+
+class SqliteStorage:
+    """Хранилище пациентов в sqlite для PatientCollection и Patient.save(storage=...).
+
+    Хранит уже нормализованные строки. База в режиме WAL, чтобы читатели не ждали писателя,
+    соединения берутся из небольшого пула, поэтому одним хранилищем можно пользоваться из разных потоков.
+    """
+
+    def __init__(self, path, pool_size=4, timeout=30.0):
+        self.path = path
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._pool = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        with self.connection() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            with connection:
+                connection.execute(f'CREATE TABLE IF NOT EXISTS patients (id INTEGER PRIMARY KEY, '
+                                   f'{", ".join(field + " TEXT NOT NULL" for field in FIELDS)})')
+                connection.execute('CREATE INDEX IF NOT EXISTS patients_phone ON patients (phone)')
+                connection.execute('CREATE INDEX IF NOT EXISTS patients_document '
+                                   'ON patients (document_type, document_id)')
+                connection.execute('CREATE INDEX IF NOT EXISTS patients_birth_date ON patients (birth_date)')
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    @contextmanager
+    def connection(self):
+        try:
+            connection = self._pool.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.pool_size
+                self._created += can_create
+            connection = self._connect() if can_create else self._pool.get()
+        try:
+            yield connection
+        finally:
+            self._pool.put(connection)
+
+    def close(self):
+        with self._lock:
+            while self._created:
+                self._pool.get().close()
+                self._created -= 1
+
+    def append_rows(self, rows, batch_size=10000):
+        # одна транзакция на пачку
+        rows = iter(rows)
+        written = 0
+        with self.connection() as connection:
+            while True:
+                batch = [tuple(row) for _, row in zip(range(batch_size), rows)]
+                if not batch:
+                    return written
+                with connection:
+                    connection.executemany(f'INSERT INTO patients ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)', batch)
+                written += len(batch)
+
+    def save_many(self, patients, batch_size=10000):
+        return self.append_rows((patient.as_row() for patient in patients), batch_size)
+
+    def save_row(self, row, on_conflict, match_phone=False):
+        # для Patient.save(on_conflict=...): 'skip' - не писать, если документ (с match_phone - и телефон) уже есть,
+        # 'replace' - удалить прежние версии и записать новую. BEGIN IMMEDIATE берёт блокировку записи
+        # до проверки, поэтому между проверкой и записью другое соединение ничего не впишет
+        key = 'document_type = ? AND document_id = ?' + (' AND phone = ?' if match_phone else '')
+        params = (row[4], row[5], row[3]) if match_phone else (row[4], row[5])
+        with self.connection() as connection, connection:
+            connection.execute('BEGIN IMMEDIATE')
+            if on_conflict == 'skip':
+                if connection.execute(f'SELECT 1 FROM patients WHERE {key} LIMIT 1', params).fetchone():
+                    return False
+            else:
+                connection.execute(f'DELETE FROM patients WHERE {key}', params)
+            connection.execute(f'INSERT INTO patients ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)', tuple(row))
+        return True
+
+    def rows(self, where='', params=(), page_size=1000):
+        # постранично по id: дописанные во время обхода строки тоже попадут, соединение между страницами свободно
+        last_id = 0
+        where = f'AND {where}' if where else ''
+        while True:
+            with self.connection() as connection:
+                page = connection.execute(f'SELECT id, {COLUMNS} FROM patients WHERE id > ? {where} '
+                                          f'ORDER BY id LIMIT ?', (last_id, *params, page_size)).fetchall()
+            if not page:
+                return
+            for row in page:
+                yield row[1:]
+            last_id = page[-1][0]
+
+    def find(self, document_type=None, birth_date_between=None, phone_prefix=None, phone=None, document=None):
+        # нормализованный запрос PatientCollection._query() как условия WHERE
+        conditions = []
+        params = []
+        if document_type is not None:
+            conditions.append('document_type = ?')
+            params.append(document_type)
+        if birth_date_between is not None:
+            since, until = birth_date_between
+            if since:
+                conditions.append('birth_date >= ?')
+                params.append(since)
+            if until:
+                conditions.append('birth_date <= ?')
+                params.append(until)
+        if phone_prefix is not None:
+            conditions.append('substr(phone, 1, ?) = ?')
+            params.extend((len(phone_prefix), phone_prefix))
+        if phone is not None:
+            conditions.append('phone = ?')
+            params.append(phone)
+        if document is not None:
+            conditions.append('document_type = ? AND document_id = ?')
+            params.extend(document)
+        return self.rows(' AND '.join(conditions), params)
+
+    def __len__(self):
+        with self.connection() as connection:
+            return connection.execute('SELECT count(*) FROM patients').fetchone()[0]
+
+    def row_slice(self, start, stop):
+        with self.connection() as connection:
+            return [row[1:] for row in connection.execute(
+                f'SELECT id, {COLUMNS} FROM patients ORDER BY id LIMIT ? OFFSET ?', (stop - start, start))]
+
+    def clear(self):
+        with self.connection() as connection, connection:
+            connection.execute('DELETE FROM patients')
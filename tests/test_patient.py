@@ -8,7 +8,10 @@ import pytest
 from homework.config import GOOD_LOG_FILE, ERROR_LOG_FILE, CSV_PATH, PHONE_FORMAT, PASSPORT_TYPE, PASSPORT_FORMAT, \
     INTERNATIONAL_PASSPORT_FORMAT, INTERNATIONAL_PASSPORT_TYPE, DRIVER_LICENSE_TYPE, DRIVER_LICENSE_FORMAT, GOOD_LOG, \
     ERROR_LOG
-from homework.patient import Patient
+from homework import metrics
+from homework.log import start_queue_logging, stop_queue_logging, fh_info
+from homework.patient import Patient, CompactPatient, DocumentType, validate_batch, check_name_value, \
+    check_date_value, check_phone_value, check_document_type_value, check_document_id_value
 from tests.constants import GOOD_PARAMS, OTHER_GOOD_PARAMS, WRONG_PARAMS, PATIENT_FIELDS
 import logging
 
@@ -205,3 +208,93 @@ def test_wrong_value_assignment(patient, field, param):
 def test_save():
     patient = Patient(*GOOD_PARAMS)
     patient.save()
+
+
+# компактный пациент
+@check_log_size("error")
+@check_log_size("good", increased=True)
+def test_compact_patient():
+    patient = CompactPatient(*OTHER_GOOD_PARAMS)
+    true_patient = Patient(*OTHER_GOOD_PARAMS)
+    for field in PATIENT_FIELDS:
+        assert getattr(patient, field) == getattr(true_patient, field), f"Wrong attribute {field}"
+    assert str(patient) == str(true_patient)
+    assert not hasattr(patient, '__dict__'), "CompactPatient should not have __dict__"
+    patient.phone = GOOD_PARAMS[3]
+    assert patient.phone == GOOD_PARAMS[3]
+
+
+@pytest.mark.parametrize("i", list(range(len(GOOD_PARAMS))))
+@check_log_size("error", increased=True)
+@check_log_size("good")
+def test_compact_patient_wrong_params(i):
+    with pytest.raises(ValueError):
+        CompactPatient(*GOOD_PARAMS[:i], WRONG_PARAMS[i], *GOOD_PARAMS[i + 1:])
+
+
+# фоновая запись логов
+@check_log_size("error", increased=True)
+@check_log_size("good", increased=True)
+def test_queue_logging():
+    start_queue_logging()
+    try:
+        Patient(*GOOD_PARAMS)
+        try:
+            Patient(*WRONG_PARAMS)
+        except ValueError:
+            pass
+    finally:
+        stop_queue_logging()
+    assert fh_info in logging.getLogger(GOOD_LOG).handlers, "File handler was not restored"
+
+
+# пакетная проверка
+def test_validate_batch():
+    values = {
+        "first_name": [GOOD_PARAMS[0], "кондрат", WRONG_PARAMS[0], 1.8],
+        "last_name": [GOOD_PARAMS[1], "коловрат", GOOD_PARAMS[1], GOOD_PARAMS[1]],
+        "birth_date": [GOOD_PARAMS[2], " 2020-01-01", "2020-02-30", GOOD_PARAMS[2]],
+        "phone": [GOOD_PARAMS[3], "8 (916) 000-00-00", "+7-916-000-00-0", "ABC"],
+        "document_type": [GOOD_PARAMS[4], "Паспорт", PASSPORT_TYPE, "справка"],
+        "document_id": [GOOD_PARAMS[5], "00 00 000 000", "0000/000000", "1"],
+    }
+    normalized, errors = validate_batch(values)
+    assert errors == [None, "birth_date: wrong format", "first_name: wrong format", "first_name: must be string"]
+    checks = {"first_name": check_name_value, "last_name": check_name_value, "birth_date": check_date_value,
+              "phone": check_phone_value,
+              "document_type": functools.partial(check_document_type_value, possible_types=DocumentType.possible_types)}
+    for field, check in checks.items():
+        for i, value in enumerate(values[field]):
+            if isinstance(value, str):
+                assert normalized[field][i] == check(value)[1], f"Wrong {field} for {value}"
+    for i, value in enumerate(values["document_id"]):
+        assert normalized["document_id"][i] == check_document_id_value(value, normalized["document_type"][i])[1]
+
+
+# метрики
+def test_metrics(tmp_path):
+    metrics.reset()
+    Patient(*GOOD_PARAMS)
+    assert metrics.snapshot() == {"counters": {}, "gauges": {}, "histograms": {}}, "Metrics recorded while disabled"
+    metrics.enable()
+    try:
+        patient = Patient(*GOOD_PARAMS)
+        with pytest.raises(ValueError):
+            patient.phone = WRONG_PARAMS[3]
+        patient.save()
+    finally:
+        metrics.disable()
+    snapshot = metrics.snapshot()
+    histograms = snapshot["histograms"]
+    assert histograms['patient_descriptor_set_seconds{field="phone"}']["count"] == 2
+    assert histograms['patient_check_seconds{check="check_document_id_value"}']["count"] == 1
+    assert histograms['patient_operation_seconds{operation="save"}']["buckets"]["+Inf"] == 1
+    assert snapshot["counters"]['patient_validation_failures_total{field="phone",reason="wrong format"}'] == 1
+    assert snapshot["counters"]["patient_bytes_written_total"] > 0
+    path = tmp_path / "metrics.prom"
+    metrics.dump_prometheus(path)
+    text = path.read_text(encoding="utf-8")
+    assert "# TYPE patient_check_seconds histogram" in text
+    assert 'patient_check_seconds_bucket{check="check_phone_value",le="+Inf"} 2' in text
+    assert 'patient_validation_failures_total{field="phone",reason="wrong format"} 1' in text
+    metrics.reset()
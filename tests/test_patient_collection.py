@@ -1,9 +1,23 @@
+import asyncio
+import multiprocessing
+import operator
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import pytest
 # для удаления
-from homework.config import PASSPORT_TYPE, CSV_PATH, GOOD_LOG_FILE, GOOD_LOG
-from homework.patient import PatientCollection, Patient
+from homework.config import PASSPORT_TYPE, DRIVER_LICENSE_TYPE, CSV_PATH, GOOD_LOG_FILE, GOOD_LOG, ERROR_LOG_FILE, \
+    ERROR_LOG
+import homework.patient
+from homework import metrics
+from homework.archive import ArchiveStorage, csv_to_archive, archive_to_csv
+from homework.binary import BinaryStorage, csv_to_binary, binary_to_csv
+from homework.index import index_path, offsets_path, keys_path
+from homework.partitioned import PartitionedStorage
+from homework.storage import SqliteStorage
+from homework.patient import PatientCollection, Patient, MemoryPatientCollection, PatientWriter, GroupCommitWriter, \
+    AsyncPatientWriter, key_cache
 from tests.constants import PATIENT_FIELDS
 import logging
 
@@ -32,10 +46,13 @@ def prepare():
         Patient(*params).save()
     yield
     # при создании пациентов появляется успешные логи, мб их тоже удалить
-    for fh in (list(logging.getLogger(GOOD_LOG).handlers))[::-1]:
+    for fh in (list(logging.getLogger(GOOD_LOG).handlers) + list(logging.getLogger(ERROR_LOG).handlers))[::-1]:
         fh.close()
     for file in [GOOD_LOG_FILE, CSV_PATH]:
         os.remove(file)
+    for file in [index_path(CSV_PATH), offsets_path(CSV_PATH), keys_path(CSV_PATH), ERROR_LOG_FILE]:
+        if os.path.exists(file):
+            os.remove(file)
 
 
 @pytest.mark.usefixtures('prepare')
@@ -82,3 +99,690 @@ def test_limit_remove_records():
     with open(CSV_PATH, 'w', encoding='utf-8') as f:
         f.write('')
     assert len([_ for _ in limit]) == 0, "Limit works wrong for empty file"
+
+
+@pytest.mark.usefixtures('prepare')
+def test_save_many():
+    collection = PatientCollection(CSV_PATH)
+    new_params = [("Митрофан", "Космодемьянский", "1999-10-15", f"7903000000{i}", PASSPORT_TYPE, f"4510 00044{i}")
+                  for i in range(5)]
+    patients = [Patient(*params) for params in new_params]
+    log_len = len(open(GOOD_LOG_FILE, encoding='utf-8').readlines())
+    assert collection.save_many(patients, batch_size=2) == len(new_params)
+    # по одной строке лога на каждую из трёх пачек
+    assert len(open(GOOD_LOG_FILE, encoding='utf-8').readlines()) == log_len + 3
+    saved = list(collection)
+    assert len(saved) == len(GOOD_PARAMS) + len(new_params)
+    for patient, true_patient in zip(saved[len(GOOD_PARAMS):], patients):
+        for field in PATIENT_FIELDS:
+            assert getattr(patient, field) == getattr(true_patient, field), f"Wrong attr {field} after save_many"
+
+
+@pytest.mark.usefixtures('prepare')
+def test_small_blocks_iteration():
+    # строки, разрезанные границей блока, должны склеиваться
+    collection = PatientCollection(CSV_PATH, block_size=7)
+    patients = list(collection)
+    assert len(patients) == len(GOOD_PARAMS)
+    for patient, params in zip(patients, GOOD_PARAMS):
+        true_patient = Patient(*params)
+        for field in PATIENT_FIELDS:
+            assert getattr(patient, field) == getattr(true_patient, field), f"Wrong attr {field} for {params}"
+    assert collection.last_scan.rows == len(GOOD_PARAMS)
+    assert collection.last_scan.bytes_read == os.path.getsize(CSV_PATH)
+
+
+@pytest.mark.usefixtures('prepare')
+def test_scan_stats():
+    stats = PatientCollection(CSV_PATH).scan_stats()
+    assert stats.rows == len(GOOD_PARAMS)
+    assert stats.bytes_read == os.path.getsize(CSV_PATH)
+    assert stats.rows_per_sec > 0 and stats.bytes_per_sec > 0
+
+
+@pytest.mark.usefixtures('prepare')
+def test_scan_metrics():
+    metrics.reset()
+    metrics.enable()
+    try:
+        assert len(list(PatientCollection(CSV_PATH))) == len(GOOD_PARAMS)
+    finally:
+        metrics.disable()
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"]["patient_rows_read_total"] == len(GOOD_PARAMS)
+    assert snapshot["counters"]["patient_bytes_read_total"] == os.path.getsize(CSV_PATH)
+    assert snapshot["histograms"]['patient_operation_seconds{operation="scan"}']["count"] == 1
+    assert snapshot["gauges"]["patient_scan_rows_per_second"] > 0
+    metrics.reset()
+
+
+@pytest.mark.usefixtures('prepare')
+def test_save_on_conflict(monkeypatch):
+    # мелкие блоки и частое слияние, чтобы на тринадцати строках пройти поиск по .keys
+    monkeypatch.setattr('homework.index.KEYS_FENCE_STEP', 2)
+    monkeypatch.setattr('homework.index.KEYS_MERGE_ROWS', 3)
+    cache = key_cache(CSV_PATH)
+    monkeypatch.setattr(cache, 'capacity', 1)
+    size = os.path.getsize(CSV_PATH)
+    assert Patient(*GOOD_PARAMS[0]).save(on_conflict='skip') is False
+    assert os.path.getsize(CSV_PATH) == size
+    assert os.path.exists(keys_path(CSV_PATH))
+    other_phone = GOOD_PARAMS[0][:3] + ("79990000000",) + GOOD_PARAMS[0][4:]
+    assert Patient(*other_phone).save(on_conflict='skip') is False
+    assert Patient(*other_phone).save(on_conflict='skip', match_phone=True) is True
+    misses = cache.misses
+    for params in GOOD_PARAMS:
+        assert Patient(*params).save(on_conflict='skip') is False
+    assert cache.misses - misses >= len(GOOD_PARAMS) - 1
+    # записанное в обход save() тоже видно: строки после .keys дочитываются
+    with open(CSV_PATH, 'a', encoding='utf-8') as f:
+        f.write("Ада,Лавлейс,1978-01-21,79160000099,паспорт,0228000099\r\n")
+    assert Patient("Ада", "Лавлейс", "1978-01-21", "79160000099", PASSPORT_TYPE, "0228000099").save(
+        on_conflict='skip') is False
+    # файл переписан на месте: .keys собирается заново
+    with open(CSV_PATH, 'r+', encoding='utf-8') as f:
+        f.write("Ада,Лавлейс,1978-01-21,79160000098,паспорт,0228000098\r\n" * 30)
+    assert Patient(*GOOD_PARAMS[1]).save(on_conflict='skip') is True
+    assert Patient("Ада", "Лавлейс", "1978-01-21", "79160000098", PASSPORT_TYPE, "0228000098").save(
+        on_conflict='skip') is False
+    renamed = ("Рональд",) + GOOD_PARAMS[7][1:]
+    assert Patient(*renamed).save(on_conflict='replace') is True
+    collection = PatientCollection(CSV_PATH)
+    assert collection.get_by_document(PASSPORT_TYPE, GOOD_PARAMS[7][5]).first_name == "Рональд"
+    with pytest.raises(ValueError):
+        Patient(*GOOD_PARAMS[0]).save(on_conflict='update')
+
+
+@pytest.mark.usefixtures('prepare')
+def test_compact():
+    Patient(*GOOD_PARAMS[0]).save()
+    Patient(*(("Рональд",) + GOOD_PARAMS[7][1:])).save()
+    other_phone = GOOD_PARAMS[2][:3] + ("79990000000",) + GOOD_PARAMS[2][4:]
+    Patient(*other_phone).save()
+    collection = PatientCollection(CSV_PATH)
+    collection.get_by_phone(GOOD_PARAMS[0][3])
+    assert os.path.exists(index_path(CSV_PATH))
+    assert collection.compact(with_phone=True) == 2
+    assert not os.path.exists(index_path(CSV_PATH))
+    assert len(list(collection)) == len(GOOD_PARAMS) + 1
+    assert collection.compact() == 1
+    assert collection.compact() == 0
+    patients = list(collection)
+    assert len(patients) == len(GOOD_PARAMS)
+    assert patients[-2].first_name == "Рональд"
+    assert patients[-1].phone == "79990000000"
+    assert collection.get_by_document(PASSPORT_TYPE, GOOD_PARAMS[7][5]).first_name == "Рональд"
+    assert collection.get_by_phone(GOOD_PARAMS[2][3]) is None
+    assert Patient(*GOOD_PARAMS[0]).save(on_conflict='skip') is False
+
+
+@pytest.mark.usefixtures('prepare')
+def test_compact_after_crash(monkeypatch):
+    Patient(*GOOD_PARAMS[0]).save()
+
+    def crash(tmp_file, csv_file, tail=b''):
+        csv_file.seek(0)
+        csv_file.write(tmp_file.read(10))
+        raise OSError('диск отвалился')
+
+    monkeypatch.setattr(homework.patient, '_copy_back', crash)
+    with pytest.raises(OSError):
+        PatientCollection(CSV_PATH).compact()
+    monkeypatch.undo()
+    assert os.path.exists(CSV_PATH + '.compact')
+    Patient("Рональд", "Уизли", "1980-03-01", "79160000099", PASSPORT_TYPE, "0228000099").save()
+    collection = PatientCollection(CSV_PATH)
+    assert collection.compact() == 0
+    assert not os.path.exists(CSV_PATH + '.compact')
+    patients = list(collection)
+    assert [patient.phone for patient in patients[:-1]] == [Patient(*params).phone
+                                                          for params in GOOD_PARAMS[1:] + GOOD_PARAMS[:1]]
+    assert patients[-1].phone == "79160000099"
+
+
+@pytest.mark.usefixtures('prepare')
+def test_get_by_phone_and_document():
+    collection = PatientCollection(CSV_PATH)
+    patient = collection.get_by_phone("+7 (916) 000-00-03")
+    assert patient.last_name == "Плакса"
+    patient = collection.get_by_document(PASSPORT_TYPE, "0228-000007")
+    assert patient.last_name == "Уизли"
+    assert collection.get_by_phone("79990000000") is None
+    assert collection.get_by_document(PASSPORT_TYPE, "0000 000000") is None
+    assert collection.get_by_phone("wrong phone") is None
+
+
+@pytest.mark.usefixtures('prepare')
+def test_index_updated_on_save():
+    collection = PatientCollection(CSV_PATH)
+    collection.rebuild_index()
+    index_size = os.path.getsize(index_path(CSV_PATH))
+    Patient("Митрофан", "Космодемьянский", "1999-10-15", "79030000000", PASSPORT_TYPE, "4510 000444").save()
+    assert os.path.getsize(index_path(CSV_PATH)) > index_size, "Index was not updated by save()"
+    assert collection.get_by_phone("79030000000").last_name == "Космодемьянский"
+    assert collection.get_by_document(PASSPORT_TYPE, "4510000444").last_name == "Космодемьянский"
+
+
+@pytest.mark.usefixtures('prepare')
+def test_index_rebuilt_after_outside_changes():
+    collection = PatientCollection(CSV_PATH)
+    assert collection.get_by_phone("79160000012").last_name == "Достоевский"
+    # переписываем файл в обход Patient.save()
+    with open(CSV_PATH, 'w', encoding='utf-8') as f:
+        f.write("Ада,Лавлейс,1978-01-21,79160000012,паспорт,0228000002\r\n")
+    assert collection.get_by_phone("79160000012").last_name == "Лавлейс"
+    assert collection.get_by_phone("79160000000") is None
+    with open(CSV_PATH, 'a', encoding='utf-8') as f:
+        f.write("Рон,Уизли,1900-04-20,79160000007,паспорт,0228000007\r\n")
+    assert collection.get_by_document(PASSPORT_TYPE, "0228000007").last_name == "Уизли"
+
+
+@pytest.mark.usefixtures('prepare')
+def test_index_rebuilt_by_other_collection():
+    first = PatientCollection(CSV_PATH)
+    assert first.get_by_phone("79160000012").last_name == "Достоевский"
+    # новый индекс длиннее старого, first дочитывал бы его с середины строки
+    with open(CSV_PATH, 'w', encoding='utf-8') as f:
+        for i in range(30):
+            f.write(f"Ада,Лавлейс,1978-01-21,7916100{i:04d},заграничный паспорт,2281{i:05d}\r\n")
+        f.write("Ада,Лавлейс,1978-01-21,79160000012,паспорт,0228000002\r\n")
+        f.write("Рон,Уизли,1900-04-20,79160000007,паспорт,0228000007\r\n")
+    PatientCollection(CSV_PATH).rebuild_index()
+    assert first.get_by_phone("79160000007").last_name == "Уизли"
+    assert first.get_by_phone("79160000012").last_name == "Лавлейс"
+
+
+@pytest.mark.usefixtures('prepare')
+def test_index_rebuilt_after_rewrite_in_place():
+    PatientCollection(CSV_PATH).rebuild_index()
+    # файл не стал короче, старые записи индекса покрывают его начало
+    with open(CSV_PATH, 'w', encoding='utf-8') as f:
+        for i in range(len(GOOD_PARAMS) + 2):
+            f.write(f"Ада,Лавлейс,1978-01-21,7916100{i:04d},заграничный паспорт,2281{i:05d}\r\n")
+    collection = PatientCollection(CSV_PATH)
+    assert collection.get_by_phone("79161000003").last_name == "Лавлейс"
+    assert collection.get_by_phone(GOOD_PARAMS[3][3]) is None
+
+
+@pytest.mark.usefixtures('prepare')
+def test_random_access():
+    collection = PatientCollection(CSV_PATH)
+    for i in (0, 5, len(GOOD_PARAMS) - 1, -1, -len(GOOD_PARAMS)):
+        assert collection[i].phone == Patient(*GOOD_PARAMS[i]).phone, f"Wrong patient with index {i}"
+    for i in (len(GOOD_PARAMS), -len(GOOD_PARAMS) - 1):
+        with pytest.raises(IndexError):
+            collection[i]
+    for item in (slice(2, 6), slice(None, None, 3), slice(10, None), slice(-3, None, -2), slice(8, 3)):
+        patients = collection[item]
+        assert [patient.phone for patient in patients] == [Patient(*params).phone for params in GOOD_PARAMS[item]], \
+            f"Wrong slice {item}"
+
+
+@pytest.mark.usefixtures('prepare')
+def test_row_offsets_heal():
+    # читатель и писатель дописали один и тот же конец строки
+    offsets = PatientCollection(CSV_PATH).row_offsets().offsets
+    with open(offsets_path(CSV_PATH), 'ab') as file:
+        offsets[-1:].tofile(file)
+    collection = PatientCollection(CSV_PATH)
+    assert len(collection.row_offsets()) == len(GOOD_PARAMS)
+    assert [patient.phone for patient in collection[-2:]] == [Patient(*params).phone for params in GOOD_PARAMS[-2:]]
+
+
+@pytest.mark.usefixtures('prepare')
+def test_row_offsets_after_rewrite_in_place():
+    assert len(PatientCollection(CSV_PATH).row_offsets()) == len(GOOD_PARAMS)
+    # строки длиннее и их больше: старая таблица покрывает начало нового файла
+    with open(CSV_PATH, 'w', encoding='utf-8') as f:
+        for i in range(30):
+            f.write(f"Ада,Лавлейс,1978-01-21,7916100{i:04d},заграничный паспорт,2281{i:05d}\r\n")
+    collection = PatientCollection(CSV_PATH)
+    assert len(collection.row_offsets()) == 30
+    assert collection[3].phone == "79161000003"
+    assert collection[20].phone == "79161000020"
+
+
+@pytest.mark.usefixtures('prepare')
+def test_page_sees_new_records():
+    collection = PatientCollection(CSV_PATH)
+    assert [patient.phone for patient in collection.page(10, 5)] == \
+           [Patient(*params).phone for params in GOOD_PARAMS[10:15]]
+    offsets_size = os.path.getsize(offsets_path(CSV_PATH))
+    new_patient = Patient("Митрофан", "Космодемьянский", "1999-10-15", "79030000000", PASSPORT_TYPE, "4510 000444")
+    new_patient.save()
+    assert os.path.getsize(offsets_path(CSV_PATH)) == offsets_size + 8, "Offsets were not updated by save()"
+    assert collection.page(len(GOOD_PARAMS), 5)[0].phone == new_patient.phone
+    with open(CSV_PATH, 'w', encoding='utf-8') as f:
+        f.write('')
+    assert collection.page(0, 5) == []
+
+
+@pytest.mark.usefixtures('prepare')
+def test_trusted_iteration():
+    log_len = len(open(GOOD_LOG_FILE, encoding='utf-8').readlines())
+    patients = list(PatientCollection(CSV_PATH, validate=False))
+    assert len(open(GOOD_LOG_FILE, encoding='utf-8').readlines()) == log_len, "Trusted load should not log"
+    assert len(patients) == len(GOOD_PARAMS)
+    for patient, params in zip(patients, GOOD_PARAMS):
+        true_patient = Patient(*params)
+        for field in PATIENT_FIELDS:
+            assert getattr(patient, field) == getattr(true_patient, field), f"Wrong attr {field} for {params}"
+    assert str(patients[0]) == str(Patient(*GOOD_PARAMS[0]))
+    # значения в доверенных пациентах по-прежнему проверяются при изменении
+    with pytest.raises(ValueError):
+        patients[0].phone = "not a phone"
+
+
+@pytest.mark.usefixtures('prepare')
+def test_parallel_load():
+    collection = PatientCollection(CSV_PATH)
+    patients = collection.load(workers=2)
+    assert [patient.phone for patient in patients] == [Patient(*params).phone for params in GOOD_PARAMS]
+    assert patients[0].first_name == GOOD_PARAMS[0][0]
+    phones = list(collection.parallel_map(operator.attrgetter('phone'), workers=3, ordered=False))
+    assert sorted(phones) == sorted(Patient(*params).phone for params in GOOD_PARAMS)
+
+
+class CountingExecutor(ProcessPoolExecutor):
+    submitted = 0
+
+    def submit(self, *args, **kwargs):
+        CountingExecutor.submitted += 1
+        return super().submit(*args, **kwargs)
+
+
+@pytest.mark.usefixtures('prepare')
+def test_parallel_map_window(monkeypatch):
+    monkeypatch.setattr(homework.patient, 'ProcessPoolExecutor', CountingExecutor)
+    collection = PatientCollection(CSV_PATH)
+    patients = collection.parallel_map(workers=1, chunks_per_worker=len(GOOD_PARAMS))
+    assert next(patients).phone == Patient(*GOOD_PARAMS[0]).phone
+    # в работе не больше двух кусков, после первого готового отправлен только один следующий
+    assert CountingExecutor.submitted == 3
+    patients.close()
+    assert CountingExecutor.submitted == 3
+    assert len(list(collection.parallel_map(workers=2, chunks_per_worker=3, ordered=False))) == len(GOOD_PARAMS)
+
+
+@pytest.mark.usefixtures('prepare')
+def test_filter():
+    collection = PatientCollection(CSV_PATH)
+    Patient("Митрофан", "Космодемьянский", "1950-10-15", "89030000000", DRIVER_LICENSE_TYPE, "4510 000444").save()
+    Patient("Агафья", "Лыкова", "1944-04-17", "79030000001", DRIVER_LICENSE_TYPE, "4510 000445").save()
+
+    def names(patients):
+        return [patient.last_name for patient in patients]
+
+    assert names(collection.filter(document_type=DRIVER_LICENSE_TYPE, birth_date_between=(None, "1945-01-01"))) == \
+           ["Лыкова"]
+    assert names(collection.filter(birth_date_between=("1970-01-01", "1972-01-11"))) == ["Рюрик", "Коловрат"]
+    assert names(collection.filter(phone_prefix="8 (903)")) == ["Космодемьянский", "Лыкова"]
+    assert names(collection.filter(phone_prefix="+7 903")) == ["Космодемьянский", "Лыкова"]
+    assert names(collection.filter(phone_prefix="903")) == []
+    assert names(collection.filter(phone="+7 903 000 00 00")) == ["Космодемьянский"]
+    assert names(collection.filter(document=(PASSPORT_TYPE, "0228 000003"), phone_prefix="7916")) == ["Плакса"]
+    assert names(collection.filter(phone="79030000001", document_type=PASSPORT_TYPE)) == []
+    assert names(collection.filter(phone="79030000001", document=(PASSPORT_TYPE, "0228 000003"))) == []
+    assert len(names(collection.filter())) == len(GOOD_PARAMS) + 2
+
+
+@pytest.mark.usefixtures('prepare')
+def test_select():
+    rows = list(PatientCollection(CSV_PATH).select('birth_date', 'document_id'))
+    assert [(row.birth_date, row.document_id) for row in rows] == \
+           [(Patient(*params).birth_date, Patient(*params).document_id) for params in GOOD_PARAMS]
+    rows = list(PatientCollection(CSV_PATH, validate=False).select('document_type', 'last_name', named=False))
+    assert rows == [(PASSPORT_TYPE, params[1].capitalize()) for params in GOOD_PARAMS]
+    with open(CSV_PATH, 'a', encoding='utf-8') as f:
+        f.write("Ада,Лавлейс,1978-01-21,79160000002,паспорт,02280\r\n")
+    with pytest.raises(ValueError):
+        list(PatientCollection(CSV_PATH).select('document_id'))
+    with pytest.raises(ValueError):
+        list(PatientCollection(CSV_PATH).select('age'))
+
+
+@pytest.mark.usefixtures('prepare')
+def test_validated_scan(monkeypatch):
+    monkeypatch.setattr(homework.patient, 'VALIDATE_BATCH_ROWS', 4)
+    with open(CSV_PATH, 'a', encoding='utf-8') as f:
+        f.write("Ада,Лавлейс,1978-01-21,не телефон,паспорт,0228000002\r\n")
+        f.write("Ада,Лавлейс,1978-01-21,79160000002\r\n")
+    patients = iter(PatientCollection(CSV_PATH))
+    for params in GOOD_PARAMS:
+        patient, true_patient = next(patients), Patient(*params)
+        for field in PATIENT_FIELDS:
+            assert getattr(patient, field) == getattr(true_patient, field), f"Wrong attr {field} for {params}"
+    with pytest.raises(ValueError):
+        next(patients)
+    rows = PatientCollection(CSV_PATH).select('first_name', 'document_id', named=False)
+    assert [next(rows) for _ in GOOD_PARAMS] == [(Patient(*params).first_name, Patient(*params).document_id)
+                                                 for params in GOOD_PARAMS]
+    assert next(rows) == ("Ада", "0228000002")
+    with pytest.raises(ValueError):
+        next(rows)
+    phones = PatientCollection(CSV_PATH).select('phone')
+    assert [next(phones).phone for _ in GOOD_PARAMS] == [Patient(*params).phone for params in GOOD_PARAMS]
+    with pytest.raises(ValueError):
+        next(phones)
+
+
+@pytest.mark.usefixtures('prepare')
+def test_memory_collection():
+    collection = MemoryPatientCollection.from_collection(PatientCollection(CSV_PATH))
+    collection.append(Patient("Митрофан", "Космодемьянский", "1999-10-15", "79030000000", "заграничный паспорт",
+                              "00 0000001"))
+    assert len(collection) == len(GOOD_PARAMS) + 1
+    for patient, params in zip(collection, GOOD_PARAMS):
+        true_patient = Patient(*params)
+        for field in PATIENT_FIELDS:
+            assert getattr(patient, field) == getattr(true_patient, field), f"Wrong attr {field} for {params}"
+    assert collection[-1].document_id == "000000001"
+
+
+@pytest.mark.usefixtures('prepare')
+def test_write_rows_and_find_errors():
+    rows = [
+        ("митрофан", "Космодемьянский", "1999-10-15", "8 903 000 00 00", "Паспорт", "4510 000444"),
+        ("Митрофан", "Космодемьянский", "1999-10-15", "79030000000", PASSPORT_TYPE, "4510"),
+        ("Митрофан", "Космодемьянский"),
+    ]
+    with PatientWriter(CSV_PATH) as writer:
+        assert writer.write_rows(rows) == [(1, "document_id: wrong format"), (2, "wrong number of fields")]
+    collection = PatientCollection(CSV_PATH)
+    assert collection.get_by_phone("79030000000").first_name == "Митрофан"
+    assert collection.find_errors(batch_size=4) == []
+    with open(CSV_PATH, 'a', encoding='utf-8') as f:
+        f.write(",".join(rows[1]) + "\r\n")
+        f.write(",".join(rows[2]) + "\r\n")
+    assert collection.find_errors(batch_size=4) == [(len(GOOD_PARAMS) + 1, "document_id: wrong format"),
+                                                    (len(GOOD_PARAMS) + 2, "wrong number of fields")]
+
+
+@pytest.fixture()
+def sqlite_storage(tmp_path):
+    storage = SqliteStorage(str(tmp_path / 'patients.db'))
+    storage.save_many(Patient(*params) for params in GOOD_PARAMS)
+    yield storage
+    storage.close()
+
+
+@pytest.mark.usefixtures('prepare')
+def test_sqlite_collection(sqlite_storage):
+    collection = PatientCollection(sqlite_storage)
+    for i, patient in enumerate(collection):
+        true_patient = Patient(*GOOD_PARAMS[i])
+        for field in PATIENT_FIELDS:
+            assert getattr(patient, field) == getattr(true_patient, field), f"Wrong attr {field} for {GOOD_PARAMS[i]}"
+    limit = collection.limit(len(GOOD_PARAMS) + 10)
+    for _ in range(len(GOOD_PARAMS)):
+        next(limit)
+    new_patient = Patient("Митрофан", "Космодемьянский", "1999-10-15", "79030000000", PASSPORT_TYPE, "4510 000444")
+    new_patient.save(sqlite_storage)
+    assert next(limit).phone == new_patient.phone, "Limit should see records added during iteration"
+    assert collection[-1].phone == new_patient.phone
+    assert [patient.phone for patient in collection.page(3, 2)] == \
+           [Patient(*params).phone for params in GOOD_PARAMS[3:5]]
+    assert collection.get_by_phone("8 903 000 00 00").last_name == "Космодемьянский"
+    assert collection.get_by_document(PASSPORT_TYPE, "0228 000003").last_name == "Плакса"
+    assert [patient.last_name for patient in collection.filter(birth_date_between=("1970-01-01", "1972-01-11"),
+                                                               phone_prefix="8916")] == ["Рюрик", "Коловрат"]
+    assert list(collection.select('phone'))[0].phone == GOOD_PARAMS[0][3]
+    sqlite_storage.clear()
+    assert len([_ for _ in collection.limit(4)]) == 0, "Limit works wrong for empty storage"
+
+
+@pytest.mark.usefixtures('prepare')
+def test_sqlite_concurrent_readers(sqlite_storage):
+    collection = PatientCollection(sqlite_storage, validate=False)
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda _: len(list(collection)), range(16)))
+    assert results == [len(GOOD_PARAMS)] * 16
+
+
+@pytest.mark.usefixtures('prepare')
+def test_sqlite_save_on_conflict(sqlite_storage, tmp_path):
+    assert Patient(*GOOD_PARAMS[0]).save(sqlite_storage, on_conflict='skip') is False
+    other_phone = GOOD_PARAMS[0][:3] + ("79990000000",) + GOOD_PARAMS[0][4:]
+    assert Patient(*other_phone).save(sqlite_storage, on_conflict='skip', match_phone=True) is True
+    renamed = ("Рональд",) + GOOD_PARAMS[7][1:]
+    assert Patient(*renamed).save(sqlite_storage, on_conflict='replace') is True
+    assert len(sqlite_storage) == len(GOOD_PARAMS) + 1
+    collection = PatientCollection(sqlite_storage)
+    assert collection.get_by_document(PASSPORT_TYPE, GOOD_PARAMS[7][5]).first_name == "Рональд"
+    with pytest.raises(TypeError):
+        Patient(*GOOD_PARAMS[0]).save(PartitionedStorage(str(tmp_path / 'patients')), on_conflict='skip')
+
+
+@pytest.mark.usefixtures('prepare')
+def test_partitioned_storage(tmp_path, monkeypatch):
+    directory = str(tmp_path / 'patients')
+    storage = PartitionedStorage(directory, workers=2)
+    other_types = [
+        ("Митрофан", "Космодемьянский", "1999-10-15", "79030000000", DRIVER_LICENSE_TYPE, "4510 000444"),
+        ("Агафья", "Лыкова", "1944-04-17", "79030000001", "заграничный паспорт", "00 0000001"),
+    ]
+    assert storage.save_many(Patient(*params) for params in GOOD_PARAMS + tuple(other_types)) == len(GOOD_PARAMS) + 2
+    storage.close()
+    collection = PatientCollection(directory)
+    assert isinstance(collection.storage, PartitionedStorage)
+    partitions = collection.storage.manifest()['partitions']
+    assert partitions['passport/1970.csv']['rows'] == 7
+    assert partitions['passport/1970.csv']['min_birth_date'] == "1971-01-11"
+    assert partitions['passport/1970.csv']['max_birth_date'] == "1978-12-31"
+    assert sum(info['rows'] for info in partitions.values()) == len(collection.storage) == len(GOOD_PARAMS) + 2
+    assert sorted(patient.phone for patient in collection) == sorted(Patient(*params).phone
+                                                                     for params in GOOD_PARAMS + tuple(other_types))
+    assert collection.storage.partitions(DRIVER_LICENSE_TYPE) == ['driver_license/1990.csv']
+    assert collection.storage.partitions(birth_date_between=(None, "1900-12-31")) == ['passport/1880.csv',
+                                                                                      'passport/1900.csv']
+    assert [patient.last_name for patient in collection.filter(birth_date_between=("1970-01-01", "1972-01-11"),
+                                                               phone_prefix="8916")] == ["Рюрик", "Коловрат"]
+    assert [patient.last_name for patient in collection.filter(document_type="заграничный паспорт")] == ["Лыкова"]
+    assert collection.get_by_document(DRIVER_LICENSE_TYPE, "4510000444").last_name == "Космодемьянский"
+    assert collection.get_by_phone("8 903 000 00 01").last_name == "Лыкова"
+    assert [patient.phone for patient in collection.limit(3)] == [patient.phone for patient in collection][:3]
+    assert [patient.phone for patient in collection[2:5]] == [patient.phone for patient in collection][2:5]
+    # чтение мелкими пачками, поток чтения не должен повиснуть, если обход бросили на середине
+    phones = [patient.phone for patient in collection]
+    monkeypatch.setattr('homework.partitioned.BATCH_ROWS', 2)
+    monkeypatch.setattr('homework.partitioned.READ_AHEAD', 1)
+    assert [patient.phone for patient in collection] == phones
+    assert [patient.phone for patient in collection.limit(3)] == phones[:3]
+    # пул процессов filter() освобождает close() коллекции, открывшей каталог
+    collection.storage.workers = 2
+    assert list(collection.filter(birth_date_between=("1900-01-01", None)))
+    executor = collection.storage._executor
+    assert executor is not None
+    with collection:
+        pass
+    assert collection.storage._executor is None
+    with pytest.raises(RuntimeError):
+        executor.submit(len, ())
+
+
+@pytest.mark.usefixtures('prepare')
+@pytest.mark.parametrize("codec", ["zlib", "lzma"])
+def test_archive(tmp_path, codec):
+    archive_path = str(tmp_path / 'patients.csvz')
+    assert csv_to_archive(CSV_PATH, archive_path, codec, rows_per_block=4) == len(GOOD_PARAMS)
+    collection = PatientCollection(archive_path)
+    assert isinstance(collection.storage, ArchiveStorage)
+    assert len(collection.storage.blocks) == 4
+    assert [str(patient) for patient in collection] == [str(Patient(*params)) for params in GOOD_PARAMS]
+    assert collection[7].last_name == "Уизли"
+    assert [patient.last_name for patient in collection[3:6]] == ["Плакса", "Фамилия", "Кузьмин"]
+    assert [patient.last_name for patient in collection.limit(2)] == ["Рюрик", "Коловрат"]
+    # родившиеся после 1978 только во втором блоке
+    assert len(collection.storage.blocks_between("1999-01-01", None)) == 1
+    assert [patient.last_name for patient in collection.filter(birth_date_between=("1999-01-01", None))] == \
+           ["Фамилия", "Кузьмин", "Поттер"]
+    assert collection.get_by_document(PASSPORT_TYPE, "0228 000011").last_name == "Районный"
+    with pytest.raises(TypeError):
+        Patient(*GOOD_PARAMS[0]).save(collection.storage)
+    csv_copy = str(tmp_path / 'copy.csv')
+    assert archive_to_csv(archive_path, csv_copy) == len(GOOD_PARAMS)
+    with open(CSV_PATH, 'rb') as original, open(csv_copy, 'rb') as copy:
+        assert original.read() == copy.read()
+
+
+@pytest.mark.usefixtures('prepare')
+def test_binary_storage(tmp_path):
+    binary_path = str(tmp_path / 'patients.bin')
+    assert csv_to_binary(CSV_PATH, binary_path) == len(GOOD_PARAMS)
+    assert os.path.getsize(binary_path) + os.path.getsize(binary_path + '.names') < os.path.getsize(CSV_PATH)
+    storage = BinaryStorage(binary_path)
+    collection = PatientCollection(storage)
+    for patient, params in zip(collection, GOOD_PARAMS):
+        true_patient = Patient(*params)
+        for field in PATIENT_FIELDS:
+            assert getattr(patient, field) == getattr(true_patient, field), f"Wrong attr {field} for {params}"
+    assert collection[7].last_name == "Уизли"
+    assert [patient.last_name for patient in collection[-2:]] == ["Районный", "Достоевский"]
+    assert collection.get_by_document(PASSPORT_TYPE, "0228 000003").last_name == "Плакса"
+    assert [patient.last_name for patient in collection.filter(birth_date_between=(None, "1900-12-31"))] == \
+           ["Плакса", "Уизли"]
+    assert list(storage.column('phone')) == [Patient(*params).phone for params in GOOD_PARAMS]
+    assert list(storage.column('document_id')) == [Patient(*params).document_id for params in GOOD_PARAMS]
+
+    limit = collection.limit(len(GOOD_PARAMS) + 10)
+    for _ in range(len(GOOD_PARAMS)):
+        next(limit)
+    new_patient = Patient("Митрофан", "Космодемьянский", "1999-10-15", "79030000000", "заграничный паспорт",
+                          "00 0000001")
+    new_patient.save(storage)
+    assert str(next(limit)) == str(new_patient), "Limit should see records added during iteration"
+
+    csv_copy = str(tmp_path / 'copy.csv')
+    assert binary_to_csv(binary_path, csv_copy, batch_size=5) == len(GOOD_PARAMS) + 1
+    assert [str(patient) for patient in PatientCollection(csv_copy)] == [str(patient) for patient in collection]
+
+
+def test_binary_storage_failed_batch(tmp_path):
+    binary_path = str(tmp_path / 'patients.bin')
+    storage = BinaryStorage(binary_path)
+    good = [Patient(*params).as_row() for params in GOOD_PARAMS[:2]]
+    broken = ["Новое", "Имя", "2000-02-30", "79160000000", PASSPORT_TYPE, "0228000000"]
+    with pytest.raises(ValueError):
+        storage.append_rows([good[0], broken])
+    storage.append_rows([["Другое", "Имя", "2000-01-01", "79160000001", PASSPORT_TYPE, "0228000001"]])
+    assert [row[:2] for row in BinaryStorage(binary_path).rows()] == [("Другое", "Имя")]
+
+
+def _concurrent_writer(path, process, threads, rows_per_thread):
+    # пишет из нескольких потоков через GroupCommitWriter, нечётные процессы - через PatientWriter
+    def params(thread, i):
+        return ("Процесс", "Поток", "2000-01-01", f"79{process:03}{thread:03}{i:03}", PASSPORT_TYPE,
+                f"{process:03}{thread:03}{i:04}")
+
+    if process % 2:
+        with PatientWriter(path, batch_size=7) as writer:
+            for thread in range(threads):
+                writer.write_many(Patient(*params(thread, i)) for i in range(rows_per_thread))
+        return
+    with GroupCommitWriter(path, max_latency=0.002, max_batch=50, fsync=False) as writer:
+        def run(thread):
+            futures = [writer.submit(Patient(*params(thread, i))) for i in range(rows_per_thread)]
+            for future in futures:
+                future.result()
+
+        with ThreadPoolExecutor(threads) as executor:
+            list(executor.map(run, range(threads)))
+
+
+@pytest.mark.usefixtures('prepare')
+def test_concurrent_appends(tmp_path):
+    path = str(tmp_path / 'concurrent.csv')
+    processes, threads, rows_per_thread = 8, 8, 40
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=_concurrent_writer, args=(path, process, threads, rows_per_thread))
+               for process in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+    collection = PatientCollection(path)
+    assert collection.find_errors() == [], "Torn or interleaved rows"
+    phones = [row.phone for row in collection.select('phone')]
+    assert len(phones) == len(set(phones)) == processes * threads * rows_per_thread
+
+
+def test_group_commit_writer_errors(tmp_path, monkeypatch):
+    path = str(tmp_path / 'group.csv')
+    patient = Patient(*GOOD_PARAMS[0])
+    commit = homework.patient.commit
+    calls = []
+
+    def failing_commit(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise RuntimeError("disk is gone")
+        return commit(*args)
+
+    monkeypatch.setattr(homework.patient, 'commit', failing_commit)
+    writer = GroupCommitWriter(path, fsync=False)
+    with pytest.raises(RuntimeError):
+        writer.save(patient)
+    writer.save(patient)
+    writer.close()
+    writer.close()
+    with pytest.raises(ValueError):
+        writer.submit(patient)
+    assert [row.phone for row in PatientCollection(path).select('phone')] == [patient.phone]
+
+
+@pytest.mark.usefixtures('prepare')
+def test_follow():
+    collection = PatientCollection(CSV_PATH)
+    follower = collection.follow(poll_interval=0.01, idle_timeout=0.05)
+    assert [patient.phone for patient in follower] == [Patient(*params).phone for params in GOOD_PARAMS]
+    assert follower.offset == os.path.getsize(CSV_PATH)
+
+    new_patient = Patient("Митрофан", "Космодемьянский", "1999-10-15", "79030000000", PASSPORT_TYPE, "4510 000444")
+    new_patient.save()
+    # после перезапуска читаются только новые строки
+    follower = collection.follow(poll_interval=0.01, idle_timeout=0.05, **follower.checkpoint())
+    assert [patient.phone for patient in follower] == [new_patient.phone]
+
+    # файл обрезали: читаем заново с начала
+    with open(CSV_PATH, 'w', encoding='utf-8') as f:
+        f.write("Рон,Уизли,1900-04-20,79160000007,паспорт,0228000007\r\n")
+    follower = collection.follow(poll_interval=0.01, idle_timeout=0.05, **follower.checkpoint())
+    assert [patient.last_name for patient in follower] == ["Уизли"]
+    assert follower.restarts == 1
+
+    # ротация: файл заменили новым
+    rotated = CSV_PATH + '.new'
+    with open(rotated, 'w', encoding='utf-8') as f:
+        f.write("Ада,Лавлейс,1978-01-21,79160000002,паспорт,0228000002\r\n"
+                "Билл,Гейтс,1978-12-31,79160000008,паспорт,0228000008\r\n")
+    os.replace(rotated, CSV_PATH)
+    follower = collection.follow(poll_interval=0.01, idle_timeout=0.05, **follower.checkpoint())
+    assert [patient.last_name for patient in follower] == ["Лавлейс", "Гейтс"]
+
+    # недописанная последняя строка не мешает закончить по idle_timeout
+    with open(CSV_PATH, 'a', encoding='utf-8') as f:
+        f.write("Рон,Уизли,1900-04-20,791600")
+    follower = collection.follow(poll_interval=0.01, idle_timeout=0.1, **follower.checkpoint())
+    started = time.monotonic()
+    assert list(follower) == []
+    assert time.monotonic() - started < 5
+
+
+@pytest.mark.usefixtures('prepare')
+def test_async_api(tmp_path):
+    path = str(tmp_path / 'async.csv')
+
+    async def scenario():
+        new_patient = Patient("Митрофан", "Космодемьянский", "1999-10-15", "79030000000", PASSPORT_TYPE, "4510 000444")
+        assert await new_patient.asave() is True
+        assert await new_patient.asave(on_conflict='skip') is False
+        phones = [patient.phone async for patient in PatientCollection(CSV_PATH).aiter(batch_size=5)]
+        assert phones == [Patient(*params).phone for params in GOOD_PARAMS] + [new_patient.phone]
+
+        async with AsyncPatientWriter(path, max_pending=10, fsync=False) as writer:
+            await writer.write_many(Patient(*params) for params in GOOD_PARAMS)
+        phones = [patient.phone async for patient in PatientCollection(path).aiter()]
+        assert sorted(phones) == sorted(Patient(*params).phone for params in GOOD_PARAMS)
+
+    asyncio.run(scenario())